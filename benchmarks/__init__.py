@@ -0,0 +1,84 @@
+"""Benchmarks of the scorers and of the leaderboard. Run them all from the
+top of the repository with benchmarks.run (or decode's own benchmark with
+benchmarks.decode).
+
+Each benchmark result is a dictionary with a unique name and the best and
+mean time, in seconds, of a number of repetitions (see measure). Results are
+written as JSON so that a later run can be compared with them.
+"""
+
+import gc
+import json
+import time
+from collections import OrderedDict
+
+
+# Repetitions of a benchmark continue for at least this long, since the
+# speed of a shared machine can change for a fraction of a second at a time
+# (and benchmarks.run runs them all in rounds for changes that last longer)
+MIN_SECONDS = 0.5
+
+def measure(name, function, repeat=5, min_seconds=MIN_SECONDS, **info):
+  """Time calls of function, at least repeat of them and for at least
+  min_seconds, with the garbage collector off (as timeit does) so that its
+  pauses do not land in some calls. Any keyword arguments are added to the
+  result, e.g., the size of the input."""
+  times = []
+  total = 0.0
+  enabled = gc.isenabled()
+  gc.disable()
+  try:
+    while len(times) < repeat or total < min_seconds:
+      start = time.time()
+      function()
+      times.append(time.time() - start)
+      total += times[-1]
+  finally:
+    if enabled:
+      gc.enable()
+  return dict(info, name=name, seconds=min(times), mean=total / len(times), repeat=len(times))
+
+
+def best_of(rounds):
+  """Merge the results of running the same benchmarks several times: each
+  benchmark's best time over all rounds, and its mean over all of them."""
+  merged = OrderedDict()
+  for results in rounds:
+    for r in results:
+      best = merged.get(r['name'])
+      if best is None or 'seconds' not in best:
+        merged[r['name']] = dict(r)
+      elif 'seconds' in r:
+        mean = (best['mean'] * best['repeat'] + r['mean'] * r['repeat']) / (best['repeat'] + r['repeat'])
+        best.update(seconds=min(best['seconds'], r['seconds']), mean=mean, repeat=best['repeat'] + r['repeat'])
+  return merged.values()
+
+
+def failed(name, error, **info):
+  """The result of a benchmark that could not be run."""
+  return dict(info, name=name, error='%s: %s' % (type(error).__name__, error))
+
+
+def write_results(results, out):
+  json.dump({'benchmarks': results}, out, indent=2, sort_keys=True)
+  out.write('\n')
+
+
+def read_results(filename):
+  with open(filename) as f:
+    return json.load(f)['benchmarks']
+
+
+def compare(results, baseline, threshold, floor):
+  """Returns (name, baseline seconds, seconds, regressed) for each benchmark
+  in both runs. A benchmark regressed if it took more than 1 + threshold
+  times as long as before; ones that took under floor seconds both times,
+  or that were timed only once (e.g., loading reference data), are too
+  noisy to judge and are left out."""
+  before = dict((r['name'], r['seconds']) for r in baseline if 'seconds' in r and r.get('repeat', 1) > 1)
+  comparison = []
+  for r in results:
+    if 'seconds' in r and r.get('repeat', 1) > 1 and r['name'] in before:
+      (old, new) = (before[r['name']], r['seconds'])
+      comparison.append((r['name'], old, new, max(old, new) >= floor and new > (1 + threshold) * old))
+  return comparison
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Per-sentence latency of decode.sentence_logprob over decoding_data/input.
+
+Scores every sentence with both sentence_logprob and the original
+reference_sentence_logprob, reports how long each took, and exits with an
+error if any pair of scores differs by more than the tolerance. Run from
+the top of the repository:
+
+  python -m benchmarks.decode [-e translations.txt]
+
+Without -e, each sentence is translated left to right with the longest
+matching phrase and its best translation.
+"""
+
+import sys
+import time
+import optparse
+
+import scoring.decode as decode
+
+
+def monotone_translation(f, table):
+  e = []
+  i = 0
+  while i < len(f):
+    for j in xrange(len(f), i, -1):
+      translations = table.get(f[i:j])
+      if translations:
+        e.extend(max(translations, key=lambda t: t[1])[0])
+        i = j
+        break
+    else:
+      e.append(f[i])
+      i += 1
+  return tuple(e)
+
+
+def timed(function, *args):
+  start = time.time()
+  result = function(*args)
+  return result, time.time() - start
+
+
+def close(a, b, tolerance):
+  if a == b:
+    return True
+  return abs(a - b) <= tolerance * max(1.0, abs(a), abs(b))
+
+
+if __name__ == '__main__':
+  optparser = optparse.OptionParser()
+  optparser.add_option("-e", "--english", dest="english", default=None, help="Translations to score (default: monotone translation)")
+  optparser.add_option("-t", "--tolerance", dest="tolerance", default=1e-9, type="float", help="Relative tolerance (default=1e-9)")
+  (opts, args) = optparser.parse_args()
+
+  french = decode.french_sentences.get()
+  if opts.english:
+    english = [tuple(line.strip().split()) for line in open(opts.english)]
+  else:
+    table = decode.translation_table()
+    english = [monotone_translation(f, table) for f in french]
+  bitext = zip(french, english)
+  (tm, lm) = decode.models(bitext)
+
+  failures = 0
+  (total_reference, total_fast) = (0.0, 0.0)
+  print 'sentence\tlen(f)\tlen(e)\treference_ms\tfast_ms\tspeedup\tlogprob'
+  for i, (f, e) in enumerate(bitext):
+    (expected, reference_seconds) = timed(decode.reference_sentence_logprob, f, e, tm, lm)
+    (actual, fast_seconds) = timed(decode.sentence_logprob, f, e, tm, lm)
+    total_reference += reference_seconds
+    total_fast += fast_seconds
+    print '%d\t%d\t%d\t%.2f\t%.2f\t%.1f\t%f' % (i, len(f), len(e), 1000 * reference_seconds, 1000 * fast_seconds,
+                                               reference_seconds / max(fast_seconds, 1e-9), actual)
+    if not close(expected, actual, opts.tolerance):
+      sys.stderr.write('Sentence %d: expected %r, got %r\n' % (i, expected, actual))
+      failures += 1
+
+  print 'total\t\t\t%.2f\t%.2f\t%.1f' % (1000 * total_reference, 1000 * total_fast, total_reference / max(total_fast, 1e-9))
+  if failures:
+    sys.stderr.write('%d sentences differ from the reference implementation\n' % (failures,))
+    sys.exit(1)
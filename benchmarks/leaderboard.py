@@ -0,0 +1,62 @@
+"""Benchmarks of rendering the leaderboard.
+
+Seeds the App Engine testbed's in-memory datastore with a number of
+handles, each with a number of submissions spread over the enabled
+assignments, then times reading the leaderboard data from the summaries and
+building the template values from it. Needs the App Engine SDK (and the
+libraries it bundles) on PYTHONPATH.
+"""
+
+from __future__ import absolute_import
+
+import random
+import datetime
+
+from benchmarks import measure
+
+SEED = 1
+
+
+def seed(leaderboard, ndb, rng, handles, submissions):
+  """Write the handles, their submissions and their summaries."""
+  keys = ndb.put_multi([leaderboard.Handle(handle='handle %d' % (i,), leaderboard=rng.random() < 0.9,
+                                           submitted_assignments=[True] * len(leaderboard.scorer))
+                        for i in xrange(handles)])
+  start = datetime.datetime(2014, 1, 1)
+  assignments = []
+  for key in keys:
+    for j in xrange(submissions):
+      number = j % len(leaderboard.scorer)
+      score = rng.uniform(0, 100)
+      assignments.append(leaderboard.Assignment(handle=key, number=number, filename='submission.txt',
+                                                score=score, test_score=score, percent_complete=100,
+                                                timestamp=start + datetime.timedelta(minutes=rng.randint(0, 100000))))
+  for i in xrange(0, len(assignments), 500):
+    ndb.put_multi(assignments[i:i+500])
+  ndb.put_multi([leaderboard.build_summary(handle) for handle in ndb.get_multi(keys)])
+
+
+def run(handles=100, submissions=20, repeat=5):
+  from google.appengine.ext import ndb
+  from google.appengine.ext import testbed
+  from google.appengine.datastore import datastore_stub_util
+  import leaderboard
+
+  bed = testbed.Testbed()
+  bed.activate()
+  try:
+    bed.setup_env(user_email='admin@example.com', user_id='1', user_is_admin='1', overwrite=True)
+    bed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    ndb.get_context().set_cache_policy(False)
+    seed(leaderboard, ndb, random.Random(SEED), handles, submissions)
+
+    page = leaderboard.LeaderBoard()
+    data = page.get_leaderboard_data()
+    size = dict(handles=handles, submissions=submissions)
+    user = leaderboard.users.get_current_user()
+    return [measure('leaderboard.data', page.get_leaderboard_data, repeat, **size),
+            measure('leaderboard.template_values', lambda: page.get_template_values(data, user), repeat, **size)]
+  finally:
+    bed.deactivate()
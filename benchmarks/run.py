@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Run the scorer and leaderboard benchmarks and write their results as JSON.
+
+  python -m benchmarks.run -o baseline.json
+  python -m benchmarks.run -b baseline.json
+
+With -b, each benchmark is compared with the one of the same name in an
+earlier run, and the exit status is 1 if any of them regressed. The
+leaderboard benchmarks are skipped (with a warning) if the App Engine SDK
+cannot be imported.
+"""
+
+import sys
+import logging
+import optparse
+
+import benchmarks
+import benchmarks.scorers
+
+
+if __name__ == '__main__':
+  optparser = optparse.OptionParser()
+  optparser.add_option("-o", "--output", dest="output", default=None, help="Write results to this file (default=stdout)")
+  optparser.add_option("-b", "--baseline", dest="baseline", default=None, help="Compare with the results in this file")
+  optparser.add_option("-t", "--threshold", dest="threshold", default=0.25, type="float", help="Slowdown that counts as a regression (default=0.25)")
+  optparser.add_option("-m", "--min-seconds", dest="floor", default=0.01, type="float", help="Ignore benchmarks faster than this (default=0.01)")
+  optparser.add_option("-r", "--repeat", dest="repeat", default=5, type="int", help="Minimum repetitions of each benchmark per round (default=5)")
+  optparser.add_option("--rounds", dest="rounds", default=3, type="int", help="Times to run all the benchmarks, keeping each one's best (default=3)")
+  optparser.add_option("-s", "--scale", dest="scale", default=10, type="int", help="Size of oversized submissions relative to valid ones (default=10)")
+  optparser.add_option("-n", "--handles", dest="handles", default=100, type="int", help="Handles on the leaderboard (default=100)")
+  optparser.add_option("-k", "--submissions", dest="submissions", default=20, type="int", help="Submissions per handle (default=20)")
+  optparser.add_option("--scorers", dest="scorers", default=None, help="Comma-separated scorers to benchmark (default=all)")
+  optparser.add_option("--no-leaderboard", dest="leaderboard", default=True, action="store_false", help="Skip the leaderboard benchmarks")
+  (opts, args) = optparser.parse_args()
+  logging.basicConfig(level=logging.ERROR) # the malformed submissions log warnings
+
+  only = opts.scorers.split(',') if opts.scorers else None
+  # Each round runs every benchmark once, so that a benchmark's best time is
+  # taken over the whole run rather than over a few seconds of it
+  rounds = [benchmarks.scorers.run(opts.scale, opts.repeat, only) for _ in xrange(opts.rounds)]
+  results = benchmarks.best_of(rounds) + benchmarks.scorers.reference_loads()
+  if opts.leaderboard:
+    try:
+      import benchmarks.leaderboard
+      results.extend(benchmarks.best_of([benchmarks.leaderboard.run(opts.handles, opts.submissions, opts.repeat)
+                                         for _ in xrange(opts.rounds)]))
+    except ImportError as e:
+      sys.stderr.write('Skipping the leaderboard benchmarks: %s\n' % (e,))
+
+  for r in results:
+    if 'error' in r:
+      sys.stderr.write('%s failed: %s\n' % (r['name'], r['error']))
+
+  if opts.output:
+    with open(opts.output, 'w') as out:
+      benchmarks.write_results(results, out)
+  elif not opts.baseline:
+    benchmarks.write_results(results, sys.stdout)
+
+  if opts.baseline:
+    comparison = benchmarks.compare(results, benchmarks.read_results(opts.baseline), opts.threshold, opts.floor)
+    print 'benchmark\tbaseline_ms\tms\tratio'
+    for (name, old, new, regressed) in comparison:
+      print '%s\t%.2f\t%.2f\t%.2f%s' % (name, 1000 * old, 1000 * new, new / old if old > 0 else float('inf'),
+                                        '\tREGRESSION' if regressed else '')
+    regressions = [c for c in comparison if c[3]]
+    if regressions:
+      sys.stderr.write('%d of %d benchmarks regressed by more than %d%%\n' %
+                       (len(regressions), len(comparison), 100 * opts.threshold))
+      sys.exit(1)
@@ -0,0 +1,149 @@
+"""Benchmarks of every scorer on synthetic submissions.
+
+Each scorer gets three submissions built from its reference data: a valid
+one (mostly right, with some errors), a malformed one, and an oversized one
+that is scale times larger in the way that costs that scorer the most. Each
+is timed with score() for the dev and the test split, after the reference
+data has been loaded. Submissions to chunked scorers (decode) also have all
+their chunks scored, as the app would do in the background.
+"""
+
+import random
+
+import scoring.upload_number
+import scoring.alignment
+import scoring.decode
+import scoring.evaluation
+import scoring.rerank
+import scoring.inflect
+import scoring.reference
+
+from benchmarks import measure, failed
+
+SEED = 1
+
+
+def read_lines(data):
+  with open(data.filename) as f:
+    return [line.rstrip('\n') for line in f]
+
+
+def upload_number_submissions(rng, scale):
+  """The number, words, and a number scale thousand digits long."""
+  return { 'valid': '42\n',
+           'malformed': 'forty-two\n',
+           'oversized': '4' * (1000 * scale) + '\n' }
+
+
+def alignment_submissions(rng, scale):
+  """The sure gold links with some replaced by random ones, a line that is
+  not a list of links, and every link repeated scale times."""
+  lines = []
+  for line in read_lines(scoring.alignment.gold_alignments):
+    links = [link for link in line.split() if '-' in link]
+    lines.append(' '.join(link if rng.random() < 0.8 else '%d-%d' % (rng.randint(0, 40), rng.randint(0, 40))
+                          for link in links))
+  malformed = list(lines)
+  malformed[len(lines) // 2] = 'these are not links'
+  return { 'valid': '\n'.join(lines),
+           'malformed': '\n'.join(malformed),
+           'oversized': '\n'.join(' '.join([line] * scale) for line in lines) }
+
+
+def decode_submissions(rng, scale):
+  """Monotone translations, one sentence too few, and scale copies."""
+  from benchmarks.decode import monotone_translation
+  table = scoring.decode.translation_table()
+  lines = [' '.join(monotone_translation(f, table)) for f in scoring.decode.french_sentences.get()]
+  return { 'valid': '\n'.join(lines),
+           'malformed': '\n'.join(lines[:-1]),
+           'oversized': '\n'.join(lines * scale) }
+
+
+def evaluation_submissions(rng, scale):
+  """The gold labels with some changed, a line that is not a label, and
+  labels padded with zeros to scale digits (which the fast path rejects)."""
+  labels = [label if rng.random() < 0.7 else rng.choice(scoring.evaluation.LABELS)
+            for label in scoring.evaluation.answers.get().labels]
+  malformed = [str(label) for label in labels]
+  malformed[len(labels) // 2] = 'x'
+  return { 'valid': '\n'.join(str(label) for label in labels),
+           'malformed': '\n'.join(malformed),
+           'oversized': '\n'.join('%0*d' % (scale, label) for label in labels) }
+
+
+def drop_words(rng, line):
+  return ' '.join(word for word in line.split() if rng.random() < 0.9)
+
+
+def rerank_submissions(rng, scale):
+  """The references with some words dropped, one sentence too few, and
+  every sentence repeated scale times."""
+  lines = [drop_words(rng, line) for split in ('dev', 'test') for line in read_lines(scoring.rerank.references[split])]
+  return { 'valid': '\n'.join(lines),
+           'malformed': '\n'.join(lines[:-1]),
+           'oversized': '\n'.join(' '.join([line] * scale) for line in lines) }
+
+
+def inflect_submissions(rng, scale):
+  """The gold forms with some words dropped, invalid UTF-8, and every line
+  repeated scale times."""
+  lines = [drop_words(rng, line) for test in (False, True) for line in read_lines(scoring.inflect.gold_forms[test])]
+  return { 'valid': '\n'.join(lines),
+           'malformed': '\n'.join(line[:len(line) // 2] + '\xff\xfe' for line in lines),
+           'oversized': '\n'.join(' '.join([line] * scale) for line in lines) }
+
+
+scorers = [
+  (scoring.upload_number, upload_number_submissions),
+  (scoring.alignment, alignment_submissions),
+  (scoring.decode, decode_submissions),
+  (scoring.evaluation, evaluation_submissions),
+  (scoring.rerank, rerank_submissions),
+  (scoring.inflect, inflect_submissions),
+]
+
+
+def name_of(scorer):
+  return scorer.__name__.split('.')[-1]
+
+
+def score_chunks(scorer, submission):
+  for chunk in scorer.chunks(submission):
+    scorer.score_chunk(chunk, submission)
+
+
+def run(scale=10, repeat=5, only=None):
+  """Returns the results of benchmarking the scorers (those named in only,
+  if given)."""
+  results = []
+  for (scorer, submissions) in scorers:
+    name = 'scorer.%s' % (name_of(scorer),)
+    if only and name_of(scorer) not in only:
+      continue
+    try:
+      generated = submissions(random.Random(SEED), scale)
+      scorer.score(generated['valid'], None) # load the reference data
+    except Exception as e:
+      results.append(failed(name, e))
+      continue
+    for kind in ('valid', 'malformed', 'oversized'):
+      submission = generated[kind]
+      for (split, test) in (('dev', False), ('test', True)):
+        results.append(measure('%s.%s.%s' % (name, kind, split), lambda: scorer.score(submission, None, test),
+                               repeat, bytes=len(submission)))
+    if hasattr(scorer, 'score_chunk'):
+      try:
+        results.append(measure('%s.valid.chunks' % (name,), lambda: score_chunks(scorer, generated['valid']),
+                               repeat, bytes=len(generated['valid'])))
+      except Exception as e:
+        results.append(failed('%s.valid.chunks' % (name,), e))
+  return results
+
+
+def reference_loads():
+  """Returns the time each reference file took to load, the one time it was
+  loaded, as results (with repeat=1, so that they are not compared)."""
+  return [dict(name='reference.%s.load' % (stats['name'],), seconds=stats['load_seconds'],
+               mean=stats['load_seconds'], repeat=1)
+          for stats in scoring.reference.stats() if stats['loaded']]
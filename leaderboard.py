@@ -2,18 +2,27 @@ import os
 import sys
 import time
 import math
+import json
 import urllib
+import glob
+import hmac
+import hashlib
 import logging
+import functools
+import threading
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
 import datetime
 
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 
 import jinja2
 import webapp2
 
+import pipeline
 import scoring.upload_number
 import scoring.alignment
 import scoring.decode
@@ -62,13 +71,20 @@ class Assignment(ndb.Model):
   handle = ndb.KeyProperty()
   number = ndb.IntegerProperty()
   filename = ndb.StringProperty()
-  filedata = ndb.BlobProperty()
+  filedata = ndb.BlobProperty() # only set on entities written before SubmissionData
+  data_hash = ndb.StringProperty()
   score = ndb.FloatProperty()
   test_score = ndb.FloatProperty()
   percent_complete = ndb.IntegerProperty()
   timestamp = ndb.DateTimeProperty(auto_now_add=True)
 
 
+class SubmissionData(ndb.Model):
+  """The contents of an uploaded file, keyed by their SHA-256 hash so that
+  identical uploads are stored once."""
+  data = ndb.BlobProperty()
+
+
 class Handle(ndb.Model):
   """A database entry recording a user's anonymizing handle."""
   user = ndb.UserProperty() # a handle with no user belongs to the admins
@@ -77,64 +93,920 @@ class Handle(ndb.Model):
   submitted_assignments = ndb.BooleanProperty(repeated=True)
 
 
-# Clean up old assignments if they never got scored
+class RescoreRun(ndb.Model):
+  """A bulk rescore of the submissions matching some filters (see RescoreJob)."""
+  number = ndb.IntegerProperty() # only rescore this assignment, if set
+  start = ndb.DateTimeProperty() # only rescore submissions uploaded in [start, end)
+  end = ndb.DateTimeProperty()
+  status = ndb.StringProperty() # running, finishing, done, failed or cancelled
+  cursor = ndb.StringProperty(indexed=False) # where the walk over submissions resumes
+  total = ndb.IntegerProperty(default=0)
+  queued = ndb.IntegerProperty(default=0)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class RescoreBatch(ndb.Model):
+  """The outcome of one batch of a RescoreRun. Each batch writes its own
+  entity, so that parallel batches never contend on the run, and its key is
+  derived from the batch's submissions, so that a batch run twice is
+  counted once."""
+  run = ndb.KeyProperty()
+  size = ndb.IntegerProperty(default=0) # submissions in the batch, including deleted ones
+  scored = ndb.IntegerProperty(default=0) # submissions given a new score
+  failed = ndb.IntegerProperty(default=0)
+  chunked = ndb.IntegerProperty(default=0) # submissions whose chunks were queued instead
+  chunks = ndb.IntegerProperty(default=0) # score_chunk jobs queued for them
+  finished = ndb.DateTimeProperty(auto_now=True)
+
+
+class RescoreChunk(ndb.Model):
+  """The outcome of one score_chunk job queued by a RescoreRun, keyed like
+  RescoreBatch so that a chunk scored twice is counted once."""
+  run = ndb.KeyProperty()
+  failed = ndb.BooleanProperty(default=False)
+  finished = ndb.DateTimeProperty(auto_now=True)
+
+
+class MigrationRun(ndb.Model):
+  """A run of one of the named migrations (see MigrationJob)."""
+  name = ndb.StringProperty()
+  dry_run = ndb.BooleanProperty()
+  status = ndb.StringProperty() # running, done, failed or cancelled
+  cursor = ndb.StringProperty(indexed=False) # where the next batch starts
+  examined = ndb.IntegerProperty(default=0)
+  written = ndb.IntegerProperty(default=0) # or that would have been, on a dry run
+  then = ndb.StringProperty(indexed=False) # migrations to run after this one, comma-separated
+  created = ndb.DateTimeProperty(auto_now_add=True)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class HandleSchema(ndb.Model):
+  """Records the number of assignments that every handle's
+  submitted_assignments has been extended to (see upgrade_handles)."""
+  assignments = ndb.IntegerProperty()
+
+
+class Secret(ndb.Model):
+  """A random key, e.g., for signing cookies."""
+  value = ndb.StringProperty(indexed=False)
+
+
+class SummaryEntry(ndb.Model):
+  """The submission currently shown on the leaderboard for one assignment,
+  and aggregates over all of the handle's submissions to it for the admin
+  panel."""
+  assignment = ndb.KeyProperty()
+  score = ndb.FloatProperty()
+  test_score = ndb.FloatProperty()
+  timestamp = ndb.DateTimeProperty()
+  submissions = ndb.IntegerProperty(default=0)
+  best_score = ndb.FloatProperty() # best dev score of a finished submission
+  last_upload = ndb.DateTimeProperty()
+
+
+class Summary(ndb.Model):
+  """A handle's leaderboard row, one entry per assignment. Keyed by the id of
+  the handle and updated whenever a submission finishes scoring or the handle
+  changes, so that the leaderboard can be rendered from a single query."""
+  user = ndb.UserProperty()
+  handle = ndb.TextProperty()
+  leaderboard = ndb.BooleanProperty()
+  entries = ndb.LocalStructuredProperty(SummaryEntry, repeated=True)
+
+  def get_entries(self):
+    """Returns one entry per assignment, padding with defaults for
+    assignments added since the summary was last written."""
+    return self.entries[:len(scorer)] + [SummaryEntry(score=default_score[i], test_score=default_score[i])
+                           for i in range(len(self.entries), len(scorer))]
+
+
+def store_filedata(filedata):
+  """Store an uploaded file unless identical contents already exist, and
+  return the hash under which it can be found."""
+  data_hash = hashlib.sha256(filedata).hexdigest()
+  key = ndb.Key(SubmissionData, data_hash)
+  if key.get() is None:
+    SubmissionData(key=key, data=filedata).put()
+  return data_hash
+
+
+def get_filedata(assignment):
+  if assignment.data_hash:
+    return ndb.Key(SubmissionData, assignment.data_hash).get().data
+  return assignment.filedata
+
+
+def get_filedata_multi(assignments):
+  """The submitted files of several assignments, read in one batch."""
+  hashes = list(set(a.data_hash for a in assignments if a.data_hash))
+  data = dict((h, d.data) for h, d in zip(hashes, ndb.get_multi([ndb.Key(SubmissionData, h) for h in hashes]))
+              if d is not None)
+  return [data.get(a.data_hash) if a.data_hash else a.filedata for a in assignments]
+
+
+# The fields of an Assignment needed to list it. Listings read these with
+# projection queries so that they never load the submitted file.
+Submission = namedtuple('Submission', 'key, handle, number, filename, score, test_score, percent_complete, timestamp')
+SUBMISSION_PROJECTION = [Assignment.filename, Assignment.score, Assignment.test_score,
+                         Assignment.percent_complete, Assignment.timestamp]
+
+
+def mark_failed(assignment):
+  assignment.percent_complete = 100
+  assignment.score = default_score[assignment.number]
+  assignment.test_score = default_score[assignment.number]
+
+
+def fail_submission(key):
+  """Mark a submission that could not be scored as finished, with the default
+  score. A submission whose score was saved before the job failed (e.g., in
+  updating the summary) keeps it."""
+  assignment = key.get()
+  if assignment is None or assignment.percent_complete == 100:
+    return
+  mark_failed(assignment)
+  assignment.put()
+  record_progress(assignment)
+  update_summary(assignment)
+
+
+# Submissions that are still unscored TIMEOUT_MINUTES after they were
+# uploaded are failed by a periodic sweep (see cron.yaml), so that pages
+# that list submissions never have to write
 TIMEOUT_MINUTES = 10
-def fail_if_old(assignment, number):
-  if assignment.score == default_score[number]:
-    earliest_time = datetime.datetime.now() - datetime.timedelta(minutes=TIMEOUT_MINUTES)
-    if assignment.timestamp < earliest_time:
-      if assignment.percent_complete != 100:
-        assignment.percent_complete = 100
-        assignment.score = default_score[number]
-        assignment.test_score = default_score[number]
-        assignment.put()
+REAP_INTERVAL_MINUTES = 5
+REAP_BATCH_SIZE = 100
+
+def reap_stale_submissions():
+  """Fail every submission that timed out while scoring. Returns how many."""
+  earliest_time = datetime.datetime.now() - datetime.timedelta(minutes=TIMEOUT_MINUTES)
+  # Datastore allows inequality filters on only one property, so the
+  # (few) unfinished submissions are fetched and their age checked here
+  query = Assignment.query(Assignment.percent_complete < 100)
+  stale = [a.key for a in query.iter(projection=[Assignment.timestamp], batch_size=REAP_BATCH_SIZE)
+           if a.timestamp < earliest_time]
+  count = 0
+  for i in xrange(0, len(stale), REAP_BATCH_SIZE):
+    assignments = [a for a in ndb.get_multi(stale[i:i+REAP_BATCH_SIZE])
+                   if a is not None and a.percent_complete < 100 and a.score == default_score[a.number]]
+    for a in assignments:
+      mark_failed(a)
+    ndb.put_multi(assignments)
+    for a in assignments:
+      record_progress(a)
+      update_summary(a)
+    count += len(assignments)
+  if count > 0:
+    logging.info('Failed %d submissions that timed out while scoring' % (count,))
+  return count
+
+pipeline.every(REAP_INTERVAL_MINUTES * 60, reap_stale_submissions)
+
+
+# Maximum number of datastore queries that gather() has in flight at once
+FETCH_CONCURRENCY = 10
+
+def gather(calls, concurrency=FETCH_CONCURRENCY):
+  """Run functions that start an asynchronous datastore operation and return
+  its ndb future (e.g., tasklets), with at most concurrency running at a
+  time. Returns their results, in order."""
+  results = [None] * len(calls)
+  pending = {}
+  started = 0
+  while started < len(calls) or pending:
+    while started < len(calls) and len(pending) < concurrency:
+      pending[calls[started]()] = started
+      started += 1
+    future = ndb.Future.wait_any(pending.keys())
+    results[pending.pop(future)] = future.get_result()
+  return results
+
+
+@ndb.tasklet
+def get_submission_history_async(handle, i):
+  query = Assignment.query(Assignment.handle== handle.key,
+                           Assignment.number == i).order(-Assignment.timestamp)
+  assignments = yield query.fetch_async(projection=SUBMISSION_PROJECTION)
+  raise ndb.Return([Submission(a.key, handle.key, i, a.filename, a.score, a.test_score, a.percent_complete, a.timestamp)
+                    for a in assignments])
 
 
 def get_submission_history(handle, i):
-  return Assignment.query(Assignment.handle== handle.key,
-                          Assignment.number == i).order(-Assignment.timestamp).fetch()
+  return get_submission_history_async(handle, i).get_result()
+
+
+def get_submission_histories(handle):
+  """The handle's submission history for every assignment, queried concurrently."""
+  return gather([functools.partial(get_submission_history_async, handle, i) for i, _ in enumerate(scorer)])
+
+
+# The progress of each handle's most recent submission to each assignment is
+# kept in memcache as a (timestamp, percent_complete) pair, so that /progress
+# can be polled without touching the datastore. Records are replaced by
+# compare-and-set, so that of concurrent writers the most recent submission
+# and the highest percentage win, and expire after PROGRESS_CACHE_SECONDS
+# (a missing record is recomputed from the submission history, and cached
+# for only PROGRESS_QUERY_CACHE_SECONDS, since the query may be stale).
+PROGRESS_CACHE_SECONDS = TIMEOUT_MINUTES * 60
+PROGRESS_QUERY_CACHE_SECONDS = 5
+PROGRESS_CAS_RETRIES = 5
+
+def progress_key(handle_key, number):
+  return 'progress:%s:%d' % (handle_key.id(), number)
+
+
+def record_progress(assignment, latest=False):
+  """Publish a submission's progress, unless a more recent submission to the
+  same assignment, or more progress, has been published. Pass latest=True
+  for new uploads."""
+  key = progress_key(assignment.handle, assignment.number)
+  value = (assignment.timestamp, assignment.percent_complete)
+  client = memcache.Client()
+  for _ in xrange(PROGRESS_CAS_RETRIES):
+    current = client.gets(key)
+    if current is None:
+      if not latest or client.add(key, value, time=PROGRESS_CACHE_SECONDS):
+        return
+    elif current >= value:
+      return
+    elif client.cas(key, value, time=PROGRESS_CACHE_SECONDS):
+      return
+  logging.warning('Could not publish the progress of %s' % (assignment.key,))
+  client.delete(key) # recomputed by the next get_progress
+
+
+def get_progress(handle_key):
+  """Returns the percent complete of the handle's most recent submission to
+  each assignment (100 if there is none)."""
+  keys = [progress_key(handle_key, i) for i, _ in enumerate(scorer)]
+  cached = memcache.get_multi(keys)
+  progress = []
+  for i, key in enumerate(keys):
+    if key not in cached:
+      latest = Assignment.query(Assignment.handle == handle_key,
+                                Assignment.number == i).order(-Assignment.timestamp).fetch(
+                                  1, projection=SUBMISSION_PROJECTION)
+      cached[key] = (latest[0].timestamp, latest[0].percent_complete) if latest else (None, 100)
+      memcache.add(key, cached[key], time=PROGRESS_QUERY_CACHE_SECONDS)
+    percent_complete = cached[key][1]
+    progress.append(100 if percent_complete is None else percent_complete)
+  return progress
 
 
 def most_recent_scored_submission(submission_history, handle, i):
   return next((a for a in submission_history if a.percent_complete == 100 or a.percent_complete is None),
               submission_history[0] if len(submission_history) > 0 else
-              Assignment(handle=handle.key, number=i, filedata=None, 
-                         score=default_score[i], percent_complete=100))
+              Submission(None, handle.key, i, None, default_score[i], None, 100, None))
+
+# Rendered leaderboards are cached in memcache under a version number that
+# every write affecting the leaderboard bumps. The version starts from the
+# current time in milliseconds so that it keeps increasing if memcache evicts it.
+# Cached data also expires after LEADERBOARD_CACHE_SECONDS, so that a summary
+# the query did not see yet is never left off for long.
+LEADERBOARD_VERSION = 'leaderboard:version'
+LEADERBOARD_MODIFIED = 'leaderboard:modified'
+LEADERBOARD_CACHE_SECONDS = 60
+
+def bump_leaderboard_version():
+  """Invalidate all cached leaderboard renders."""
+  memcache.incr(LEADERBOARD_VERSION, initial_value=int(time.time() * 1000))
+  memcache.set(LEADERBOARD_MODIFIED, datetime.datetime.utcnow().replace(microsecond=0))
+
+
+def get_leaderboard_version():
+  """Returns the current leaderboard version and the time it last changed."""
+  cached = memcache.get_multi([LEADERBOARD_VERSION, LEADERBOARD_MODIFIED])
+  if len(cached) < 2:
+    bump_leaderboard_version()
+    cached = memcache.get_multi([LEADERBOARD_VERSION, LEADERBOARD_MODIFIED])
+  return (cached.get(LEADERBOARD_VERSION, 0),
+          cached.get(LEADERBOARD_MODIFIED, datetime.datetime.utcnow().replace(microsecond=0)))
+
+
+# Students often upload the same file more than once. Finished scores are
+# remembered under the scorer, the split, the hash of the submission and the
+# version of the reference data, in a bounded in-process LRU in front of
+# memcache. Changing any file under scoring/*_data (its size or modification
+# time) changes the version; clear_score_memo() invalidates everything scored
+# so far.
+SCORE_MEMO_SIZE = 1000
+SCORE_MEMO_GENERATION = 'score:generation'
+
+class LRUCache(object):
+  """A thread-safe dictionary holding at most max_entries items, evicting
+  the least recently used one first."""
+  def __init__(self, max_entries):
+    self.max_entries = max_entries
+    self.items = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      value = self.items.pop(key, None)
+      if value is not None:
+        self.items[key] = value
+      return value
+
+  def set(self, key, value):
+    with self.lock:
+      self.items.pop(key, None)
+      self.items[key] = value
+      while len(self.items) > self.max_entries:
+        self.items.popitem(last=False)
+
+  def clear(self):
+    with self.lock:
+      self.items.clear()
+
+score_memo = LRUCache(SCORE_MEMO_SIZE)
+reference_version = None
+
+def get_reference_version():
+  """Returns a hash of the names, sizes and modification times of all
+  reference data used by the scorers. The files are not read, so this is
+  cheap enough to compute on the first upload an instance handles."""
+  global reference_version
+  if reference_version is None:
+    digest = hashlib.sha1()
+    filenames = []
+    for data_dir in glob.glob(os.path.join(os.path.dirname(__file__), 'scoring', '*_data')):
+      for (dirpath, _, names) in os.walk(data_dir): # including, e.g., decoding_data/packed
+        filenames.extend(os.path.join(dirpath, name) for name in names)
+    for filename in sorted(filenames):
+      stat = os.stat(filename)
+      digest.update('%s:%d:%r\n' % (os.path.relpath(filename, os.path.dirname(__file__)), stat.st_size, stat.st_mtime))
+    reference_version = digest.hexdigest()[:16]
+  return reference_version
+
+
+def score_memo_keys(number, data_hash):
+  """Returns the memo keys of the dev and test scores of a submission."""
+  generation = memcache.get(SCORE_MEMO_GENERATION)
+  if generation is None:
+    generation = memcache.incr(SCORE_MEMO_GENERATION, initial_value=int(time.time() * 1000))
+  return ['score:%s:%s:%s:%s:%s' % (scorer[number].__name__, split, data_hash,
+                                    get_reference_version(), generation)
+          for split in ('dev', 'test')]
+
+
+def remember_score(number, data_hash, test, result):
+  """Memoize a (score, percent_complete) pair if scoring has finished."""
+  if result[1] == 100:
+    memo_key = score_memo_keys(number, data_hash)[1 if test else 0]
+    score_memo.set(memo_key, result)
+    memcache.set(memo_key, result)
+
+
+def recall_scores(number, data_hash):
+  """Returns the memoized score_all results for a submission, or None."""
+  memo_keys = score_memo_keys(number, data_hash)
+  results = [score_memo.get(memo_key) for memo_key in memo_keys]
+  if None in results:
+    cached = memcache.get_multi(memo_keys)
+    results = [cached.get(memo_key) for memo_key in memo_keys]
+    if None in results:
+      return None
+    for memo_key, result in zip(memo_keys, results):
+      score_memo.set(memo_key, result)
+  return results
+
+
+def clear_score_memo():
+  """Forget all memoized scores, e.g., after fixing reference data or a scorer."""
+  global reference_version
+  memcache.incr(SCORE_MEMO_GENERATION, initial_value=int(time.time() * 1000))
+  score_memo.clear()
+  reference_version = None
+
+
+def summary_key(handle_key):
+  return ndb.Key(Summary, handle_key.id())
+
+
+def sync_summary(handle):
+  """Copy the handle's display settings to its summary, creating it if needed."""
+  summary = _sync_summary(handle)
+  bump_leaderboard_version()
+  return summary
+
+
+@ndb.transactional()
+def _sync_summary(handle):
+  summary = summary_key(handle.key).get() or Summary(key=summary_key(handle.key))
+  summary.user = handle.user
+  summary.handle = handle.handle
+  summary.leaderboard = handle.leaderboard
+  summary.put()
+  return summary
+
+
+def better(number, score, other):
+  """Whether score ranks above other on assignment number."""
+  if other is None:
+    return score is not None
+  return score > other if reverse_order[number] else score < other
+
+
+def new_summary(handle):
+  return Summary(key=summary_key(handle.key),
+                 user=handle.user,
+                 handle=handle.handle,
+                 leaderboard=handle.leaderboard)
+
+
+def update_summary(assignment):
+  """Make a scored submission its handle's current leaderboard entry, unless
+  a more recent submission has already finished scoring."""
+  _update_summary(assignment)
+  bump_leaderboard_version() # only once the summary is committed
+
+
+@ndb.transactional(xg=True)
+def _update_summary(assignment):
+  summary = summary_key(assignment.handle).get() or new_summary(assignment.handle.get())
+  entries = summary.get_entries()
+  entry = entries[assignment.number]
+  if better(assignment.number, assignment.score, entry.best_score):
+    entry.best_score = assignment.score
+  if entry.timestamp is None or entry.timestamp <= assignment.timestamp:
+    entry.assignment = assignment.key
+    entry.score = assignment.score
+    entry.test_score = assignment.test_score
+    entry.timestamp = assignment.timestamp
+  summary.entries = entries
+  summary.put()
+
+
+@ndb.transactional(xg=True)
+def record_upload(assignment):
+  """Count a new submission in its handle's summary."""
+  summary = summary_key(assignment.handle).get() or new_summary(assignment.handle.get())
+  entries = summary.get_entries()
+  entry = entries[assignment.number]
+  entry.submissions += 1
+  entry.last_upload = max(entry.last_upload, assignment.timestamp) if entry.last_upload else assignment.timestamp
+  summary.entries = entries
+  summary.put()
+
+
+def build_summary(handle):
+  """Compute a handle's summary from its full submission history."""
+  entries = []
+  for i, history in enumerate(get_submission_histories(handle)):
+    a = most_recent_scored_submission(history, handle, i)
+    best = None
+    for s in history:
+      if (s.percent_complete == 100 or s.percent_complete is None) and better(i, s.score, best):
+        best = s.score
+    entries.append(SummaryEntry(assignment=a.key,
+                                score=a.score,
+                                test_score=a.test_score,
+                                timestamp=a.timestamp,
+                                submissions=len(history),
+                                best_score=best,
+                                last_upload=history[0].timestamp if history else None))
+  summary = new_summary(handle)
+  summary.entries = entries
+  return summary
+
 
 def update_handle(handle):
+  """Extend the handle's submitted_assignments to the current list of
+  scorers. Returns whether it changed."""
   if handle.submitted_assignments is None:
     handle.submitted_assignments = []
   new_assignments = len(scorer) - len(handle.submitted_assignments) 
   if new_assignments > 0:
     handle.submitted_assignments.extend([True] * (new_assignments-1))
     handle.submitted_assignments.append(False)
-    handle.put()
-  return handle
-  
-def get_handle(user, request):
+    return True
+  return False
+
+
+handles_upgraded = False
+
+def upgrade_handles():
+  """Run update_handle on every handle, once each time the list of scorers
+  grows. Each process checks whether this is needed the first time it looks
+  up a handle."""
+  global handles_upgraded
+  if handles_upgraded:
+    return
+  key = ndb.Key(HandleSchema, 'submitted_assignments')
+  schema = key.get()
+  if schema is None or schema.assignments != len(scorer):
+    changed = []
+    for handle in Handle.query().iter(batch_size=100):
+      if update_handle(handle):
+        changed.append(handle)
+      if len(changed) == 100:
+        ndb.put_multi(changed)
+        changed = []
+    ndb.put_multi(changed)
+    HandleSchema(key=key, assignments=len(scorer)).put()
+  handles_upgraded = True
+
+
+# A user's handle key never changes, so it is cached: for the rest of the
+# request, in an in-process LRU keyed by user ID, and in a signed cookie that
+# lets any instance skip the Handle query. The entity itself is read with
+# key.get(), which ndb caches in memcache and keeps up to date on every put.
+HANDLE_CACHE_SIZE = 10000
+HANDLE_COOKIE = 'handle'
+HANDLE_COOKIE_MAX_AGE = 30 * 24 * 60 * 60
+
+handle_keys = LRUCache(HANDLE_CACHE_SIZE)
+cookie_secret = None
+
+def sign(value):
+  global cookie_secret
+  if cookie_secret is None:
+    cookie_secret = Secret.get_or_insert('cookies', value=os.urandom(32).encode('hex')).value
+  return hmac.new(cookie_secret, value, hashlib.sha256).hexdigest()
+
+
+def read_handle_cookie(user, request):
+  try:
+    (user_id, urlsafe, signature) = request.cookies.get(HANDLE_COOKIE, '').split('|')
+  except ValueError:
+    return None
+  if user_id != user.user_id() or not hmac.compare_digest(signature, sign('%s|%s' % (user_id, urlsafe))):
+    return None
+  return ndb.Key(urlsafe=urlsafe)
+
+
+def write_handle_cookie(user, handle_key, response):
+  value = '%s|%s' % (user.user_id(), handle_key.urlsafe())
+  response.set_cookie(HANDLE_COOKIE, '%s|%s' % (value, sign(value)),
+                      max_age=HANDLE_COOKIE_MAX_AGE, path='/', httponly=True)
+
+
+def get_handle_key(user, request, response=None):
+  """The key of the viewer's handle (or None if they have none), looked up
+  without creating or updating it. Pass the response to set the cookie."""
+  if 'handle_key' in request.registry:
+    return request.registry['handle_key']
   # special case: admin users can request to appear as another handle
-  if users.is_current_user_admin():
-    req_handle = request.get('as')
-    if req_handle:
-      logging.info('Admin requested user %s' % req_handle)
-      user_handle = ndb.Key(urlsafe=req_handle).get()
-      return update_handle(user_handle)
-      
-  query_result = Handle.query(Handle.user == user).fetch()
-  if len(query_result) == 0:
+  if users.is_current_user_admin() and request.get('as'):
+    logging.info('Admin requested user %s' % request.get('as'))
+    key = ndb.Key(urlsafe=request.get('as'))
+  else:
+    key = handle_keys.get(user.user_id())
+    if key is None:
+      key = read_handle_cookie(user, request)
+      if key is None:
+        keys = Handle.query(Handle.user == user).fetch(2, keys_only=True)
+        if len(keys) > 1:
+          logging.warning('More than one handle for user %s' % (user.nickname(),))
+        key = keys[0] if keys else None
+        if key is not None and response is not None:
+          write_handle_cookie(user, key, response)
+      if key is not None:
+        handle_keys.set(user.user_id(), key)
+  request.registry['handle_key'] = key
+  return key
+
+
+def get_handle(user, request, response=None):
+  """The viewer's handle, created if they don't have one yet."""
+  if 'handle' in request.registry:
+    return request.registry['handle']
+  upgrade_handles()
+  key = get_handle_key(user, request, response)
+  user_handle = key.get() if key is not None else None
+  if user_handle is None and key is not None:
+    if users.is_current_user_admin() and request.get('as'):
+      logging.warning('Admin requested missing handle %s' % (request.get('as'),))
+      webapp2.abort(404)
+    # e.g., a cookie for a handle that has since been deleted
+    user_handle = Handle.query(Handle.user == user).get()
+  if user_handle is None:
     user_handle = Handle(user = user, 
                          leaderboard = True, 
                          handle = user.nickname())
+    update_handle(user_handle)
     user_handle.put()
-    return update_handle(user_handle)
-  elif len(query_result) == 1:
-    return update_handle(query_result[0])
-  else:
-    logging.warning('More than one handle for user %s' % (user.nickname(),))
-    return update_handle(query_result[0])
+    sync_summary(user_handle)
+    handle_keys.set(user.user_id(), user_handle.key)
+    request.registry['handle_key'] = user_handle.key
+    if response is not None:
+      write_handle_cookie(user, user_handle.key, response)
+  request.registry['handle'] = user_handle
+  return user_handle
+
+
+def save_handle(user_handle, request):
+  """Store a changed handle, and use the new version for the rest of the request."""
+  user_handle.put()
+  request.registry['handle'] = user_handle
+
+
+def apply_scores(assignment, results):
+  ((assignment.score, assignment.percent_complete), (assignment.test_score, _)) = results
+
+
+def record_scores(assignment, results):
+  """Store the dev and test results of scoring a submission."""
+  apply_scores(assignment, results)
+  assignment.put()
+  record_progress(assignment)
+  if assignment.percent_complete == 100:
+    update_summary(assignment)
+
+
+class ScoreJob(pipeline.Job):
+  """Score an uploaded submission on the dev and test sets. Scorers that work
+  in chunks (e.g., decode) report the dev set as incomplete, and a
+  score_chunk job is then queued for each chunk."""
+  name = 'score'
+
+  def prepare(self, params):
+    assignment = ndb.Key(urlsafe=params['key']).get()
+    return (assignment.number, get_filedata(assignment))
+
+  @staticmethod
+  def run(args):
+    (number, filedata) = args
+    return scorer[number].score_all(filedata, None)
+
+  def finish(self, params, results):
+    assignment = ndb.Key(urlsafe=params['key']).get()
+    remember_score(assignment.number, assignment.data_hash, False, results[0])
+    remember_score(assignment.number, assignment.data_hash, True, results[1])
+    record_scores(assignment, results)
+    if assignment.percent_complete < 100 and hasattr(scorer[assignment.number], 'score_chunk'):
+      enqueue_chunks(assignment, get_filedata(assignment))
+
+  def fail(self, params):
+    fail_submission(ndb.Key(urlsafe=params['key']))
+
+pipeline.register(ScoreJob())
+
+
+def enqueue_chunks(assignment, filedata, rescore_run=None):
+  """Queue a score_chunk job for each chunk of a chunked scorer's submission,
+  on behalf of the RescoreRun with urlsafe key rescore_run, if given.
+  Returns the number of jobs queued."""
+  chunks = scorer[assignment.number].chunks(filedata)
+  for chunk in chunks:
+    params = {'key': assignment.key.urlsafe(),
+              'number': str(assignment.number),
+              'chunk': str(chunk)}
+    if rescore_run is not None:
+      params['rescore'] = rescore_run
+    pipeline.enqueue('score_chunk', params)
+  return len(chunks)
+
+
+class ScoreChunkJob(pipeline.Job):
+  """Score one chunk of a submission's dev set."""
+  name = 'score_chunk'
+
+  def prepare(self, params):
+    assignment = ndb.Key(urlsafe=params['key']).get()
+    return (assignment.number, int(params['chunk']), get_filedata(assignment))
+
+  @staticmethod
+  def run(args):
+    (number, chunk, filedata) = args
+    return scorer[number].score_chunk(chunk, filedata)
+
+  def finish(self, params, sentence_scores):
+    number = int(params['number'])
+    key = ndb.Key(urlsafe=params['key'])
+    scorer[number].save_chunk(key, int(params['chunk']), sentence_scores, bool(params.get('rescore')))
+    if params.get('rescore'):
+      record_rescore_chunk(params, False)
+    try:
+      scorer[number].merge_chunk_into_oracle(key, int(params['chunk']))
+    except Exception:
+      # the oracle is shared by every submission, so its transaction may
+      # fail under contention; the score is saved, so merge it later
+      logging.exception('Merging chunk %s of %s into the oracle failed' % (params['chunk'], params['key']))
+      pipeline.enqueue('merge_oracle', {'key': params['key'], 'number': params['number'], 'chunk': params['chunk']})
+    assignment = key.get()
+    record_progress(assignment)
+    if assignment.percent_complete == 100:
+      if assignment.score != default_score[number]:
+        remember_score(number, assignment.data_hash, False, (assignment.score, 100))
+      update_summary(assignment)
+    else:
+      bump_leaderboard_version() # the oracle may have changed
+
+  def fail(self, params):
+    if params.get('rescore'):
+      # the submission keeps the score it had before the rescore
+      super(ScoreChunkJob, self).fail(params)
+      record_rescore_chunk(params, True)
+      return
+    fail_submission(ndb.Key(urlsafe=params['key']))
+
+pipeline.register(ScoreChunkJob())
+
+
+# A rescore walks the matching submissions by query cursor, RESCORE_PAGE_SIZE
+# keys per step, checkpointing the cursor after each step so that it can be
+# resumed. Each page is scored as rescore_batch jobs of RESCORE_BATCH_SIZE
+# submissions, which run in parallel, write their results with put_multi and
+# record their counts in a RescoreBatch (and the chunks they queue, in a
+# RescoreChunk each). Once the walk is over, finish_rescore_runs marks the
+# run done when every batch and chunk has been counted.
+RESCORE_PAGE_SIZE = 500
+RESCORE_BATCH_SIZE = 50
+
+def rescore_query(run):
+  query = Assignment.query()
+  if run.number is not None:
+    query = query.filter(Assignment.number == run.number)
+  if run.start is not None:
+    query = query.filter(Assignment.timestamp >= run.start)
+  if run.end is not None:
+    query = query.filter(Assignment.timestamp < run.end)
+  if run.start is not None or run.end is not None:
+    query = query.order(Assignment.timestamp)
+  return query
+
+
+def record_rescore_batch(params, scored, failed, chunked=0, chunks=0):
+  key = ndb.Key(RescoreBatch, hashlib.sha1(params['run'] + ':' + params['keys']).hexdigest())
+  RescoreBatch(key=key, run=ndb.Key(urlsafe=params['run']), size=len(params['keys'].split(',')),
+               scored=scored, failed=failed, chunked=chunked, chunks=chunks).put()
+
+
+def record_rescore_chunk(params, failed):
+  key = ndb.Key(RescoreChunk, hashlib.sha1('%s:%s:%s' % (params['rescore'], params['key'], params['chunk'])).hexdigest())
+  RescoreChunk(key=key, run=ndb.Key(urlsafe=params['rescore']), failed=failed).put()
+
+
+class RescoreJob(pipeline.Job):
+  """One step of the walk over the submissions of a RescoreRun: queue a page
+  of them for rescoring, save the cursor, and queue the next step. A step
+  whose cursor the run has already moved past (e.g., a task that ran twice)
+  does nothing."""
+  name = 'rescore'
+
+  def prepare(self, params):
+    run = ndb.Key(urlsafe=params['run']).get()
+    if run.status != 'running' or run.cursor != params.get('cursor'):
+      return None
+    cursor = Cursor(urlsafe=run.cursor) if run.cursor else None
+    (keys, next_cursor, more) = rescore_query(run).fetch_page(RESCORE_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+    return ([key.urlsafe() for key in keys], next_cursor.urlsafe() if more and next_cursor else None)
+
+  @staticmethod
+  def run(args):
+    return args
+
+  def finish(self, params, page):
+    if page is None: # cancelled, or already done
+      return
+    (keys, cursor) = page
+    # The batches are queued before the checkpoint so that none are lost if
+    # it fails; a batch that is queued twice is harmless (see RescoreBatch)
+    for i in xrange(0, len(keys), RESCORE_BATCH_SIZE):
+      pipeline.enqueue('rescore_batch', {'run': params['run'], 'keys': ','.join(keys[i:i+RESCORE_BATCH_SIZE])})
+    if self.checkpoint(ndb.Key(urlsafe=params['run']), params.get('cursor'), cursor, len(keys)) and cursor is not None:
+      pipeline.enqueue('rescore', {'run': params['run'], 'cursor': cursor})
+
+  @ndb.transactional()
+  def checkpoint(self, run_key, start, cursor, queued):
+    run = run_key.get()
+    if run.cursor != start:
+      return False
+    run.cursor = cursor
+    run.queued += queued
+    if cursor is None:
+      run.status = 'finishing'
+    run.put()
+    return True
+
+  def fail(self, params):
+    super(RescoreJob, self).fail(params)
+    run = ndb.Key(urlsafe=params['run']).get()
+    run.status = 'failed'
+    run.put()
+
+pipeline.register(RescoreJob())
+
+
+class RescoreBatchJob(pipeline.Job):
+  """Rescore a batch of submissions with score_all. Submissions to chunked
+  scorers (decode) have their chunks rescored instead, and keep their old
+  score until every chunk has been replaced; they are counted as chunked,
+  and their chunks separately. A submission whose file is missing or whose
+  scorer raises keeps its old score and is counted as failed."""
+  name = 'rescore_batch'
+
+  def prepare(self, params):
+    assignments = ndb.get_multi([ndb.Key(urlsafe=key) for key in params['keys'].split(',')])
+    found = [a for a in assignments if a is not None]
+    filedata = dict(zip([a.key for a in found], get_filedata_multi(found)))
+    return [(a.number, filedata[a.key]) if a is not None else None for a in assignments]
+
+  @staticmethod
+  def run(args):
+    results = []
+    for item in args:
+      result = None
+      if item is not None and item[1] is not None:
+        try:
+          result = scorer[item[0]].score_all(item[1], None)
+        except Exception:
+          logging.exception('Rescoring a submission to assignment %d failed' % (item[0],))
+      results.append(result)
+    return results
+
+  def finish(self, params, results):
+    assignments = ndb.get_multi([ndb.Key(urlsafe=key) for key in params['keys'].split(',')])
+    (changed, failed, chunked, chunks) = ([], 0, 0, 0)
+    for a, result in zip(assignments, results):
+      if a is None:
+        continue
+      if result is None:
+        failed += 1
+        continue
+      elif result[0][1] < 100 and hasattr(scorer[a.number], 'score_chunk'):
+        chunks += enqueue_chunks(a, get_filedata(a), params['run'])
+        chunked += 1
+        continue
+      else:
+        apply_scores(a, result)
+        remember_score(a.number, a.data_hash, False, result[0])
+        remember_score(a.number, a.data_hash, True, result[1])
+      changed.append(a)
+    ndb.put_multi(changed)
+    for a in changed:
+      if a.percent_complete == 100:
+        update_summary(a)
+    record_rescore_batch(params, len(changed), failed, chunked, chunks)
+    bump_leaderboard_version()
+
+  def fail(self, params):
+    super(RescoreBatchJob, self).fail(params)
+    record_rescore_batch(params, 0, len(params['keys'].split(',')))
+
+pipeline.register(RescoreBatchJob())
+
+
+# Scorers whose oracle is computed from stored per-sentence scores (decode)
+# rebuild it by merging in ORACLE_BATCH_SIZE stored entities at a time
+ORACLE_BATCH_SIZE = 100
+
+class RebuildOracleJob(pipeline.Job):
+  """One batch of rebuilding a scorer's oracle: merge the scores of a page
+  of the entities of one of its oracle_sources() into the oracle, and queue
+  the next page. Merging is idempotent, so a batch that runs twice does no
+  harm."""
+  name = 'rebuild_oracle'
+
+  def prepare(self, params):
+    kind = scorer[int(params['number'])].oracle_sources()[int(params['source'])]
+    cursor = Cursor(urlsafe=params['cursor']) if params.get('cursor') else None
+    (keys, next_cursor, more) = kind.query().fetch_page(ORACLE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    return ([key.urlsafe() for key in keys], next_cursor.urlsafe() if more and next_cursor else None)
+
+  @staticmethod
+  def run(args):
+    return args
+
+  def finish(self, params, page):
+    (keys, cursor) = page
+    s = scorer[int(params['number'])]
+    s.merge_into_oracle([e for e in ndb.get_multi([ndb.Key(urlsafe=key) for key in keys]) if e is not None])
+    bump_leaderboard_version()
+    source = int(params['source'])
+    if cursor is not None:
+      pipeline.enqueue('rebuild_oracle', {'number': params['number'], 'source': str(source), 'cursor': cursor})
+    elif source + 1 < len(s.oracle_sources()):
+      pipeline.enqueue('rebuild_oracle', {'number': params['number'], 'source': str(source + 1)})
+    else:
+      logging.info('Rebuilt oracle for %s' % (s.name,))
+
+pipeline.register(RebuildOracleJob())
+
+
+class MergeOracleJob(pipeline.Job):
+  """Merge a scored chunk into the oracle, for a score_chunk job that could
+  not. Giving up only leaves the oracle short until it is rebuilt."""
+  name = 'merge_oracle'
+
+  def prepare(self, params):
+    return None
+
+  @staticmethod
+  def run(args):
+    return args
+
+  def finish(self, params, result):
+    scorer[int(params['number'])].merge_chunk_into_oracle(ndb.Key(urlsafe=params['key']), int(params['chunk']))
+    bump_leaderboard_version()
+
+pipeline.register(MergeOracleJob())
 
 
 Message = namedtuple('Message', 'body, type')
+LeaderboardRow = namedtuple('LeaderboardRow', 'handle, user, leaderboard, scores')
 
 
 class MainPage(webapp2.RequestHandler):
@@ -145,7 +1017,7 @@ class MainPage(webapp2.RequestHandler):
       return self.redirect(users.create_login_url(self.request.uri))
 
     messages = []
-    user_handle = get_handle(user, self.request)
+    user_handle = get_handle(user, self.request, self.response)
 
     if user_handle.user != user:
       body = 'Any changes made on this page will affect handle %s.' % (user_handle.handle,)
@@ -155,14 +1027,11 @@ class MainPage(webapp2.RequestHandler):
     # the most recent submission that is 100% complete. For the most
     # recent assignment, collect its upload history
     assignments = []
-    history = []
+    history = get_submission_histories(user_handle)
     progress = [] # ... of the assignment currently uploading
-    for i, _ in enumerate(scorer):
-      history.append(get_submission_history(user_handle, i))
-      for assignment in history[-1]:
-        fail_if_old(assignment, i)
-      assignments.append(most_recent_scored_submission(history[-1], user_handle, i))
-      progress.append(history[-1][0].percent_complete if len(history[-1]) > 0 else 100)
+    for i, submissions in enumerate(history):
+      assignments.append(most_recent_scored_submission(submissions, user_handle, i))
+      progress.append(submissions[0].percent_complete if len(submissions) > 0 else 100)
 
     DEADLINES_PASSED = [datetime.datetime.now() >= x for x in DEADLINES]
     template_values = {
@@ -184,19 +1053,36 @@ class MainPage(webapp2.RequestHandler):
     self.response.write(template.render(template_values))
 
 
+# Clients long-poll /progress: a request waits up to PROGRESS_MAX_WAIT seconds
+# for the progress to differ from what the client last saw
+PROGRESS_MAX_WAIT = 25
+PROGRESS_POLL_SECONDS = 1
+
 class Progress(webapp2.RequestHandler):
+  """Returns the percent complete of the viewer's most recent submission to
+  each assignment, as a JSON list. With wait=N, blocks for up to N seconds
+  until the list differs from last=P0,P1,... (the list the client has)."""
   def get(self):
     user = users.get_current_user()
-    if user is None:
-      self.response.write("0")
+    handle_key = get_handle_key(user, self.request, self.response) if user is not None else None
+    if self.request.get('i'): # pages loaded before /progress returned a list
+      number = int(self.request.get('i'))
+      self.response.write(get_progress(handle_key)[number] if handle_key is not None else 0)
       return
-    user_handle = get_handle(user, self.request)
-    number = int(self.request.get('i'))
-    history = get_submission_history(user_handle, number)
-    progress = 100
-    if len(history) > 0:
-      progress = history[0].percent_complete 
-    self.response.write(progress)
+
+    progress = get_progress(handle_key) if handle_key is not None else []
+    try:
+      last = [int(p) for p in self.request.get('last').split(',') if p]
+      wait = min(float(self.request.get('wait', 0)), PROGRESS_MAX_WAIT)
+    except ValueError:
+      return self.abort(400)
+    deadline = time.time() + wait
+    while handle_key is not None and progress == last and time.time() < deadline:
+      time.sleep(PROGRESS_POLL_SECONDS)
+      progress = get_progress(handle_key)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.write(json.dumps(progress))
  
 
 class Submit(webapp2.RequestHandler):
@@ -204,9 +1090,10 @@ class Submit(webapp2.RequestHandler):
     user = users.get_current_user()
     if user is None:
       return self.redirect(users.create_login_url(self.request.uri))
-    user_handle = get_handle(user, self.request)
+    user_handle = get_handle(user, self.request, self.response)
     user_handle.submitted_assignments[int(self.request.get('number'))] = True
-    user_handle.put()
+    save_handle(user_handle, self.request)
+    bump_leaderboard_version()
     self.redirect('/?as=%s' % (self.request.get('as'),))
 
 
@@ -215,129 +1102,485 @@ class Upload(webapp2.RequestHandler):
     user = users.get_current_user()
     if user is None:
       return self.redirect(users.create_login_url(self.request.uri))
-    user_handle = get_handle(user, self.request)
+    user_handle = get_handle(user, self.request, self.response)
     number = int(self.request.get('number'))
     filedata = self.request.get('file')
+    data_hash = store_filedata(filedata)
     assignment = Assignment(handle = user_handle.key,
                             number = number,
                             score = default_score[number],
                             test_score = default_score[number],
                             percent_complete = 0,
-                            filedata = filedata,
+                            data_hash = data_hash,
                             filename = self.request.POST.multi['file'].filename)
     key = assignment.put() # only  way to get a key without fudging one? -- alopez
-    (score, percent_complete) = scorer[number].score(filedata, key)
-    (test_score, _) = scorer[number].score(filedata, key, test=True)
-    assignment.score = score
-    assignment.test_score = test_score
-    assignment.percent_complete = percent_complete
-    assignment.put() 
+    record_progress(assignment, latest=True)
+    record_upload(assignment)
+    results = recall_scores(number, data_hash)
+    if results is None:
+      pipeline.enqueue('score', {'key': key.urlsafe()})
+    else:
+      record_scores(assignment, results)
     self.redirect('/?as=%s' % (self.request.get('as'),))
 
 
 class QueuedScore(webapp2.RequestHandler):
+  """Runs decode chunks queued before scoring moved to the pipeline."""
   def post(self):
-    number = int(self.request.get('number'))
-    key = ndb.Key(urlsafe=self.request.get('key'))
-    data = self.request.get('data')
-    scorer[number].queued_score(data, key)
+    pipeline.jobs['score_chunk'].execute({'key': self.request.get('key'),
+                                          'number': self.request.get('number'),
+                                          'chunk': self.request.get('data')})
     
 
-## This triggers a potentially large update, so I've disabled it -- alopez
-#class Rescore(webapp2.RequestHandler):
-#  """Trigger manual rescoring of assignments."""
-#  def get(self):
-#    user = users.get_current_user()
-#    for a in Assignment.query().fetch():
-#      if a.filedata:
-#        old_score = a.score
-#        a.score = scorer[a.number].score(a.filedata)
-#        a.test_score = scorer[a.number].score(a.filedata, test=True)
-#        a.put()
-#    self.redirect('/?')
-
-
 class ChangeHandle(webapp2.RequestHandler):
   def post(self):
     user = users.get_current_user()
     if user is None:
       return self.redirect(users.create_login_url(self.request.uri))
-    user_handle = get_handle(user, self.request)
+    user_handle = get_handle(user, self.request, self.response)
     user_handle.handle = self.request.get('handle')
     user_handle.leaderboard = (self.request.get('leaderboard') == 'True')
-    user_handle.put()
+    save_handle(user_handle, self.request)
+    sync_summary(user_handle)
     self.redirect('/?as=%s' % (self.request.get('as'),))
 
 
+# Migrations bring entities written under an older schema up to date. A
+# migration is a function from a batch of entities of one model to the
+# entities that have to be written, as a list of lists: each list is written
+# only once every entity in the lists before it has been, e.g., so that a
+# file is stored before the only other copy of it is removed. A migration
+# must not write anything itself and must return nothing for entities that
+# are already up to date, so that it can be resumed or run again safely and
+# a dry run can count its writes. Each list is written with the migration's
+# write function, put_multi unless it needs something safer.
+# MigrationJob runs it over the whole model, MIGRATION_BATCH_SIZE entities
+# at a time.
+MIGRATION_BATCH_SIZE = 100
+
+Migration = namedtuple('Migration', 'name, model, function, write')
+migrations = OrderedDict()
+
+def migration(name, model, write=ndb.put_multi):
+  def register(function):
+    migrations[name] = Migration(name, model, function, write)
+    return function
+  return register
+
+
+def legacy_property(entity, name):
+  """The value of a property that is still stored on old entities but is no
+  longer part of their model, or None."""
+  prop = entity._properties.get(name)
+  return prop._get_value(entity) if prop is not None else None
+
+
+@migration('assignments', Assignment)
+def migrate_assignments(assignments):
+  """Fill in fields added since the assignment was uploaded, and move the
+  submitted file to SubmissionData."""
+  handles = {} # user -> handle key, looked up once per user in the batch
+  files = {}
+  changed = []
+  for a in assignments:
+    modified = False
+    if a.percent_complete is None:
+      a.percent_complete = 100
+      modified = True
+    if a.test_score is None:
+      a.test_score = default_score[a.number] # wrong, but expedient
+      modified = True
+    if a.filedata is not None:
+      a.data_hash = hashlib.sha256(a.filedata).hexdigest()
+      files[a.data_hash] = SubmissionData(key=ndb.Key(SubmissionData, a.data_hash), data=a.filedata)
+      a.filedata = None
+      modified = True
+    if a.handle is None:
+      user = legacy_property(a, 'user')
+      if user not in handles:
+        query_result = Handle.query(Handle.user == user).fetch(2, keys_only=True)
+        handles[user] = query_result[0] if len(query_result) == 1 else None
+        if handles[user] is None:
+          logging.warning('Found %d handles for user %s, did not update' % (len(query_result), user))
+      if handles[user] is not None:
+        a.handle = handles[user]
+        modified = True
+    if modified:
+      changed.append(a)
+  return [files.values(), changed]
+
+
+@migration('handles', Handle)
+def migrate_handles(handles):
+  """Extend submitted_assignments to the current list of scorers."""
+  return [[handle for handle in handles if update_handle(handle)]]
+
+
+# Number of times a recomputed summary is recomputed again because the
+# stored one changed before it could be replaced
+SUMMARY_MIGRATION_RETRIES = 3
+
+@ndb.transactional()
+def replace_summary(old, summary):
+  """Store summary if the stored summary is still old. Returns whether it did."""
+  if summary.key.get() != old:
+    return False
+  summary.put()
+  return True
+
+
+def write_summaries(changes):
+  """Store recomputed summaries, given as (old, summary) pairs, without
+  losing an upload or a score that commits after the old one was read: a
+  summary that has changed since is recomputed."""
+  for (old, summary) in changes:
+    for _ in xrange(SUMMARY_MIGRATION_RETRIES):
+      if replace_summary(old, summary):
+        break
+      old = summary.key.get()
+      summary = build_summary(ndb.Key(Handle, summary.key.id()).get())
+    else:
+      logging.warning('Summary %s kept changing, did not update' % (summary.key.id(),))
+
+
+@migration('summaries', Handle, write=write_summaries)
+def migrate_summaries(handles):
+  """Recompute leaderboard summaries from the submission histories."""
+  current = ndb.get_multi([summary_key(handle.key) for handle in handles])
+  return [[(old, summary) for summary, old in zip(map(build_summary, handles), current) if summary != old]]
+
+
+class MigrationJob(pipeline.Job):
+  """One batch of a MigrationRun: migrate the entities after the cursor it
+  was queued with, save the next cursor, and queue the next batch. A batch
+  whose cursor the run has already moved past (e.g., a task that ran twice)
+  does nothing."""
+  name = 'migrate'
+
+  def prepare(self, params):
+    run = ndb.Key(urlsafe=params['run']).get()
+    if run.status != 'running' or run.cursor != params.get('cursor'):
+      return None
+    cursor = Cursor(urlsafe=run.cursor) if run.cursor else None
+    query = migrations[run.name].model.query()
+    (keys, next_cursor, more) = query.fetch_page(MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    return ([key.urlsafe() for key in keys], next_cursor.urlsafe() if more and next_cursor else None)
+
+  @staticmethod
+  def run(args):
+    return args
+
+  def finish(self, params, page):
+    if page is None: # cancelled, or already done
+      return
+    (keys, cursor) = page
+    run_key = ndb.Key(urlsafe=params['run'])
+    run = run_key.get()
+    entities = [e for e in ndb.get_multi([ndb.Key(urlsafe=key) for key in keys]) if e is not None]
+    stages = migrations[run.name].function(entities)
+    written = sum(len(writes) for writes in stages)
+    if written and not run.dry_run:
+      for writes in stages:
+        migrations[run.name].write(writes) # waits for every write to commit
+      bump_leaderboard_version()
+    if self.checkpoint(run_key, params.get('cursor'), cursor, len(entities), written):
+      if cursor is not None:
+        pipeline.enqueue('migrate', {'run': params['run'], 'cursor': cursor})
+      elif run.then:
+        start_migration(run.then.split(','), run.dry_run)
+
+  @ndb.transactional()
+  def checkpoint(self, run_key, start, cursor, examined, written):
+    run = run_key.get()
+    if run.cursor != start:
+      return False
+    run.cursor = cursor
+    run.examined += examined
+    run.written += written
+    if cursor is None:
+      run.status = 'done'
+    run.put()
+    return True
+
+  def fail(self, params):
+    super(MigrationJob, self).fail(params)
+    run = ndb.Key(urlsafe=params['run']).get()
+    run.status = 'failed'
+    run.put()
+
+pipeline.register(MigrationJob())
+
+
+MigrationStatus = namedtuple('MigrationStatus', 'run, per_second')
+
+def migration_status(run):
+  """A run with its throughput (entities examined per second)."""
+  elapsed = (run.updated - run.created).total_seconds()
+  return MigrationStatus(run, run.examined / elapsed if elapsed > 0 else 0.0)
+
+
+def start_migration(names, dry_run=False):
+  """Run the named migrations one after another."""
+  run = MigrationRun(name=names[0], then=','.join(names[1:]), dry_run=dry_run, status='running')
+  run.put()
+  pipeline.enqueue('migrate', {'run': run.key.urlsafe()})
+  return run
+
+
 class UpdateSchema(webapp2.RequestHandler):
-  '''admin function: update entities created before the schema was extended'''
+  '''admin function: start, resume, cancel and monitor migrations of entities
+  created before the schema was extended'''
+  def get(self):
+    if users.is_current_user_admin():
+      if self.request.get('start'):
+        names = migrations.keys() if self.request.get('start') == 'all' else [self.request.get('start')]
+        if all(name in migrations for name in names):
+          start_migration(names, dry_run=bool(self.request.get('dry_run')))
+        return self.redirect('/update_schema')
+      if self.request.get('resume'):
+        run = ndb.Key(urlsafe=self.request.get('resume')).get()
+        if run.status in ('failed', 'cancelled'):
+          run.status = 'running'
+          run.put()
+          params = {'run': run.key.urlsafe()}
+          if run.cursor is not None:
+            params['cursor'] = run.cursor
+          pipeline.enqueue('migrate', params)
+        return self.redirect('/update_schema')
+      if self.request.get('cancel'):
+        run = ndb.Key(urlsafe=self.request.get('cancel')).get()
+        if run.status == 'running':
+          run.status = 'cancelled'
+          run.put()
+        return self.redirect('/update_schema')
+
+      user = users.get_current_user()
+      template = JINJA_ENVIRONMENT.get_template('migrations.html')
+      template_values = {
+        'user': user.email(),
+        'logout': users.create_logout_url('/'),
+        'migrations': [(m.name, m.function.__doc__) for m in migrations.values()],
+        'runs': [migration_status(run) for run in MigrationRun.query().order(-MigrationRun.created).fetch(20)],
+      }
+      self.response.write(template.render(template_values))
+    else:
+      self.redirect('/?')
+
+
+def parse_date(value):
+  return datetime.datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+RescoreStatus = namedtuple('RescoreStatus', 'run, examined, scored, failed, chunks, chunks_done, chunks_failed, '
+                                            'per_second, eta, complete')
+
+def rescore_status(run):
+  """A run with the totals of its finished batches and chunks, its
+  throughput (submissions examined per second) and estimated time remaining,
+  if it is still going. complete is whether every batch and chunk it queued
+  has finished."""
+  batches = RescoreBatch.query(RescoreBatch.run == run.key).fetch()
+  examined = sum(b.size for b in batches)
+  chunks = sum(b.chunks for b in batches)
+  chunks_done = RescoreChunk.query(RescoreChunk.run == run.key).count()
+  chunks_failed = RescoreChunk.query(RescoreChunk.run == run.key, RescoreChunk.failed == True).count()
+  last = max([b.finished for b in batches] + [run.updated])
+  elapsed = (last - run.created).total_seconds()
+  per_second = examined / elapsed if elapsed > 0 else 0.0
+  eta = None
+  if run.status in ('running', 'finishing') and per_second > 0:
+    eta = datetime.timedelta(seconds=int(max(run.total - examined, 0) / per_second))
+  complete = run.status == 'finishing' and examined >= run.queued and chunks_done >= chunks
+  return RescoreStatus(run, examined, sum(b.scored for b in batches), sum(b.failed for b in batches),
+                       chunks, chunks_done, chunks_failed, per_second, eta, complete)
+
+
+@ndb.transactional()
+def mark_rescore_done(run_key):
+  run = run_key.get()
+  if run.status == 'finishing':
+    run.status = 'done'
+    run.put()
+
+
+def finish_rescore_runs():
+  """Mark every finishing rescore whose batches and chunks have all been
+  counted as done. Returns how many."""
+  count = 0
+  for run in RescoreRun.query(RescoreRun.status == 'finishing'):
+    if rescore_status(run).complete:
+      mark_rescore_done(run.key)
+      count += 1
+  return count
+
+pipeline.every(REAP_INTERVAL_MINUTES * 60, finish_rescore_runs)
+
+
+class Rescore(webapp2.RequestHandler):
+  '''admin function: start, resume, cancel and monitor bulk rescoring'''
+  def get(self):
+    if users.is_current_user_admin():
+      if self.request.get('start'):
+        number = self.request.get('number')
+        run = RescoreRun(number=int(number) if number else None,
+                         start=parse_date(self.request.get('from')),
+                         end=parse_date(self.request.get('to')),
+                         status='running')
+        run.total = rescore_query(run).count()
+        run.put()
+        pipeline.enqueue('rescore', {'run': run.key.urlsafe()})
+        return self.redirect('/rescore')
+      if self.request.get('resume'):
+        run = ndb.Key(urlsafe=self.request.get('resume')).get()
+        if run.status in ('failed', 'cancelled'):
+          run.status = 'running'
+          run.put()
+          params = {'run': run.key.urlsafe()}
+          if run.cursor is not None:
+            params['cursor'] = run.cursor
+          pipeline.enqueue('rescore', params)
+        return self.redirect('/rescore')
+      if self.request.get('cancel'):
+        run = ndb.Key(urlsafe=self.request.get('cancel')).get()
+        if run.status == 'running':
+          run.status = 'cancelled'
+          run.put()
+        return self.redirect('/rescore')
+
+      user = users.get_current_user()
+      template = JINJA_ENVIRONMENT.get_template('rescore.html')
+      template_values = {
+        'user': user.email(),
+        'logout': users.create_logout_url('/'),
+        'assignments': [(i, s.name) for i, s in enumerate(scorer)],
+        'runs': [rescore_status(run) for run in RescoreRun.query().order(-RescoreRun.created).fetch(20)],
+      }
+      self.response.write(template.render(template_values))
+    else:
+      self.redirect('/?')
+
+
+class ClearScoreMemo(webapp2.RequestHandler):
+  '''admin function: forget memoized scores after reference data changes'''
   def get(self):
     if users.is_current_user_admin():
-      count = 0
-      for a in Assignment.query().fetch():
-        modified = False
-        if a.percent_complete is None:
-          a.percent_complete = 100
-          modified = True
-        if a.test_score is None:
-          a.test_score = default_score[a.number] # wrong, but expedient
-          modified = True
-        if a.handle is None:
-          query_result = Handle.query(Handle.user == a.user).fetch()
-          if len(query_result) == 1:
-            a.handle = query_result[0].key
-            modified = True
-          else:
-            logging.warning('Found %d handles for user %s, did not update' % (len(query_result), a.user))
-        if modified:
-          count += 1
-          a.put()
-      self.response.write('Updated %d assignments\n' % (count,))
+      clear_score_memo()
+      self.response.write('Cleared memoized scores\n')
     else:
-     self.redirect('/?')
+      self.redirect('/?')
+
+
+class RebuildOracle(webapp2.RequestHandler):
+  '''admin function: recompute the oracle scores from all submissions'''
+  def get(self):
+    if users.is_current_user_admin():
+      for i, s in enumerate(scorer):
+        if hasattr(s, 'reset_oracle'):
+          s.reset_oracle()
+          pipeline.enqueue('rebuild_oracle', {'number': str(i), 'source': '0'})
+          self.response.write('Rebuilding oracle for %s in the background\n' % (s.name,))
+      bump_leaderboard_version()
+    else:
+      self.redirect('/?')
+
+
+class ReapStaleSubmissions(webapp2.RequestHandler):
+  '''cron (or admin) function: fail submissions that timed out while scoring'''
+  def get(self):
+    if self.request.headers.get('X-AppEngine-Cron') == 'true' or users.is_current_user_admin():
+      count = reap_stale_submissions()
+      self.response.write('Failed %d stale submissions\n' % (count,))
+    else:
+      self.redirect('/?')
+
+
+class FinishRescoreRuns(webapp2.RequestHandler):
+  '''cron (or admin) function: mark rescores whose batches have all finished as done'''
+  def get(self):
+    if self.request.headers.get('X-AppEngine-Cron') == 'true' or users.is_current_user_admin():
+      count = finish_rescore_runs()
+      self.response.write('Finished %d rescores\n' % (count,))
+    else:
+      self.redirect('/?')
 
 
 class LeaderBoard(webapp2.RequestHandler):
   def get(self, extension):
-    template_values = self.get_template_values()
+    version, modified = get_leaderboard_version()
+    data_key = 'leaderboard:data:%d' % (version,)
+    data = memcache.get(data_key)
+    if data is None:
+      data = self.get_leaderboard_data()
+      memcache.set(data_key, data, time=LEADERBOARD_CACHE_SECONDS)
 
-    if extension == 'html':
-      template = JINJA_ENVIRONMENT.get_template('leaderboard.html')
-      self.response.write(template.render(template_values))
+    # Admins see everyone's names, and users hidden from the leaderboard see
+    # themselves; everyone else shares the public variant
+    user = users.get_current_user()
+    if users.is_current_user_admin():
+      variant = 'admin'
+    elif user is not None and any(row.user == user and not row.leaderboard for row in data['rows']):
+      variant = 'user:%s' % (user.user_id(),)
+    else:
+      variant = 'public'
 
+    etag = hashlib.md5('%d:%s:%s' % (version, extension, variant)).hexdigest()
+    self.response.headers['Cache-Control'] = 'private, no-cache'
+    self.response.etag = etag
+    self.response.last_modified = modified
+    if self.request.if_none_match:
+      not_modified = etag in self.request.if_none_match
     else:
-      template = JINJA_ENVIRONMENT.get_template('leaderboard.js')
-      self.response.write(template.render(template_values))
+      since = self.request.if_modified_since
+      not_modified = since is not None and modified <= since.replace(tzinfo=None)
+    if not_modified:
+      self.response.status = 304
+      return
 
-  def get_template_values(self):
-    user = users.get_current_user()
-    handles = []
+    render_key = 'leaderboard:render:%s' % (etag,)
+    body = memcache.get(render_key)
+    if body is None:
+      if extension == 'html':
+        template = JINJA_ENVIRONMENT.get_template('leaderboard.html')
+      else:
+        template = JINJA_ENVIRONMENT.get_template('leaderboard.js')
+      body = template.render(self.get_template_values(data, user))
+      memcache.set(render_key, body, time=LEADERBOARD_CACHE_SECONDS)
+    self.response.write(body)
+
+  def get_leaderboard_data(self):
+    """Returns the viewer-independent leaderboard contents: one row per
+    handle and the oracle score of each assignment."""
+    # the keys run while the oracles are computed; the summaries themselves
+    # are read by key, which is strongly consistent
+    summary_keys = Summary.query().fetch_async(keys_only=True)
+    oracle = []
+    for i, s in enumerate(scorer):
+      o = s.oracle()
+      oracle.append(o if o else default_score[i])
+    rows = [LeaderboardRow(summary.handle, summary.user, summary.leaderboard,
+                           [entry.score for entry in summary.get_entries()])
+            for summary in ndb.get_multi(summary_keys.get_result()) if summary is not None]
+    return { 'rows': rows, 'oracle': oracle }
+
+  def get_template_values(self, data, user):
     hidden_users = []
     names = {}
-    for handle in Handle.query().fetch():
+    scores = defaultdict(list)
+    for row in data['rows']:
       # Ignore leaderboard prefs for self and for admins
-      if handle.leaderboard:
-        handles.append(handle)
-      elif user is not None and (handle.user == user or users.is_current_user_admin()):
-        handles.append(handle)
-        hidden_users.append(handle.handle)
+      if not row.leaderboard:
+        if user is None or not (row.user == user or users.is_current_user_admin()):
+          continue
+        hidden_users.append(row.handle)
       if users.is_current_user_admin():
-        if handle.user:
-          names[handle.handle] = handle.user.nickname()
+        if row.user:
+          names[row.handle] = row.user.nickname()
         else:
-          names[handle.handle] = 'admin'
+          names[row.handle] = 'admin'
+      scores[row.handle] = row.scores
 
-    scores = defaultdict(list)
-    for handle in handles:
-      for i, _ in enumerate(scorer):
-        history = get_submission_history(handle, i)
-        for assignment in history:
-          fail_if_old(assignment, i)
-        scores[handle.handle].append(most_recent_scored_submission(history, handle, i).score)
+    scores['oracle'] = data['oracle']
 
-    for i, s in enumerate(scorer):
-      scores['oracle'].append(s.oracle() if s.oracle() else default_score[i])
-        
     def score_sort(x, y):
       index = CURRENT_ASSIGNMENT
       while index >= 0:
@@ -369,50 +1612,73 @@ class LeaderBoard(webapp2.RequestHandler):
 
     return template_values
 
+# The admin panel lists every handle's summary; a handle's submissions are
+# listed a page at a time
+ADMIN_PAGE_SIZE = 50
+
+AdminRow = namedtuple('AdminRow', 'handle_key, user, handle, entries')
+
 class AdminPanel(webapp2.RequestHandler):
-  '''admin function: update entities created before the schema was extended'''
+  '''admin function: list every handle's submissions'''
   def get(self):
     if users.is_current_user_admin():
-      handles = Handle.query().fetch()
-      hw_data = defaultdict(list)
-       
-      assignments = Assignment.query().order(-Assignment.timestamp).fetch()
-      for a in assignments:
-        hw_data[a.handle].append(a)
-    
       user = users.get_current_user()
-      template = JINJA_ENVIRONMENT.get_template('admin.html')
       template_values = {
         'user': user.email(),
         'logout': users.create_logout_url('/'),
-        'handles': handles,
-        'assignments': hw_data,
+        'assignments': [(i, s.name) for i, s in enumerate(scorer)],
       }
+      if self.request.get('handle'):
+        template_values.update(self.get_submissions(ndb.Key(urlsafe=self.request.get('handle')),
+                                                    self.request.get('cursor')))
+      else:
+        template_values['rows'] = [AdminRow(ndb.Key(Handle, summary.key.id()), summary.user,
+                                            summary.handle, summary.get_entries())
+                                   for summary in Summary.query().fetch()]
+      template = JINJA_ENVIRONMENT.get_template('admin.html')
       self.response.write(template.render(template_values))
     else:
       self.redirect('/?')
 
+  def get_submissions(self, handle_key, cursor):
+    """One page of a handle's submissions, most recent first."""
+    query = Assignment.query(Assignment.handle == handle_key).order(-Assignment.timestamp)
+    (page, next_cursor, more) = query.fetch_page(ADMIN_PAGE_SIZE,
+                                                 start_cursor=Cursor(urlsafe=cursor) if cursor else None,
+                                                 projection=[Assignment.number] + SUBMISSION_PROJECTION)
+    return {
+      'handle': handle_key.get(),
+      'submissions': [Submission(a.key, handle_key, a.number, a.filename, a.score, a.test_score,
+                                 a.percent_complete, a.timestamp) for a in page],
+      'next_cursor': next_cursor.urlsafe() if more and next_cursor else None,
+    }
+
 
 class GetSubmission(webapp2.RequestHandler):
   '''Download a student's submission file'''
   def get(self):
     if users.is_current_user_admin():
       a = ndb.Key(urlsafe=self.request.get('id')).get()
-      self.response.write(a.filedata)
+      self.response.write(get_filedata(a))
     else:
       self.redirect('/?')
 
 
-application = webapp2.WSGIApplication([
+application = pipeline.scheduled(webapp2.WSGIApplication([
   ('/', MainPage),
   ('/upload', Upload),
   ('/handle', ChangeHandle),
   (r'/leaderboard\.(\w+)', LeaderBoard),
   ('/queued_score', QueuedScore),
+  (pipeline.WORKER_URL, pipeline.Worker),
   ('/progress', Progress),
   ('/update_schema', UpdateSchema),
+  ('/clear_score_memo', ClearScoreMemo),
+  ('/rebuild_oracle', RebuildOracle),
+  ('/reap_stale_submissions', ReapStaleSubmissions),
+  ('/finish_rescore_runs', FinishRescoreRuns),
+  ('/rescore', Rescore),
   ('/admin', AdminPanel),
   ('/get_submission', GetSubmission),
   ('/submit', Submit),
-#  ('/rescore', Rescore),
-], debug=True)
+], debug=True))
@@ -0,0 +1,248 @@
+"""Asynchronous jobs.
+
+A job is a subclass of Job registered with register(). enqueue(name, params)
+hands it to the configured backend, which runs it in three steps:
+
+  args = job.prepare(params)      # read whatever the job needs
+  result = job.run(args)          # the work itself, with no datastore access
+  job.finish(params, result)      # record the result
+
+and retries it up to RETRIES times if any step raises, after which
+job.fail(params) is called instead.
+
+In production the backend is the App Engine task queue: each job is a push
+task POSTed to WORKER_URL, where Worker runs all three steps. On the
+development server (and in tests) jobs run in a local concurrent.futures
+process pool: prepare() and finish() run in the calling process and run()
+in a worker process. Set the PIPELINE_BACKEND environment variable (e.g., in
+app.yaml) to 'taskqueue' or 'local' to choose explicitly.
+
+Periodic work is run by App Engine cron (see cron.yaml), which the
+development server ignores, so there every(seconds, function) runs it from
+a LocalScheduler thread instead. The thread is started by the first request
+to an application wrapped with scheduled(), never by importing a module.
+"""
+
+import os
+import time
+import logging
+import threading
+
+import webapp2
+
+try:
+  from google.appengine.api import taskqueue
+except ImportError:
+  taskqueue = None
+
+try:
+  import concurrent.futures
+except ImportError:
+  concurrent = None
+
+WORKER_URL = '/pipeline'
+QUEUE_NAME = 'default'
+
+# Number of times a failing job is retried before it is given up on
+RETRIES = 3
+
+# Number of worker processes used by the local backend (0 runs jobs inline)
+MAX_WORKERS = 4
+
+jobs = {}
+
+
+class Job(object):
+  """A kind of asynchronous work. Subclasses set name and override run(),
+  and usually prepare() and finish(). run() must be a static method (so that
+  it can be sent to a worker process) and must not use the datastore."""
+  name = None
+
+  def prepare(self, params):
+    return params
+
+  @staticmethod
+  def run(args):
+    raise NotImplementedError
+
+  def finish(self, params, result):
+    pass
+
+  def fail(self, params):
+    logging.error('Giving up on job %s %s' % (self.name, params))
+
+  def execute(self, params):
+    """Run all steps of the job in this process."""
+    self.finish(params, self.run(self.prepare(params)))
+
+
+def register(job):
+  jobs[job.name] = job
+  return job
+
+
+def _run(name, args):
+  # module-level, so that worker processes can unpickle it
+  return jobs[name].run(args)
+
+
+class TaskQueueBackend(object):
+  """Runs each job as a push task on an App Engine task queue."""
+  def __init__(self, queue_name=QUEUE_NAME, retries=RETRIES):
+    self.queue_name = queue_name
+    self.retries = retries
+
+  def submit(self, name, params):
+    task_params = dict(params)
+    task_params['job'] = name
+    taskqueue.add(url=WORKER_URL,
+                  params=task_params,
+                  queue_name=self.queue_name,
+                  retry_options=taskqueue.TaskRetryOptions(task_retry_limit=self.retries))
+
+
+class LocalBackend(object):
+  """Runs jobs in a pool of local worker processes, or inline if the pool is
+  disabled or concurrent.futures is not available."""
+  def __init__(self, max_workers=MAX_WORKERS, retries=RETRIES):
+    self.retries = retries
+    self.executor = None
+    if max_workers > 0 and concurrent is not None:
+      self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    self.pending = set()
+    self.lock = threading.Lock()
+
+  def submit(self, name, params, attempt=0):
+    job = jobs[name]
+    try:
+      args = job.prepare(params)
+      if self.executor is None:
+        job.finish(params, job.run(args))
+        return
+      future = self.executor.submit(_run, name, args)
+    except Exception:
+      self.retry(name, params, attempt)
+      return
+    with self.lock:
+      self.pending.add(future)
+    future.add_done_callback(lambda f: self.done(name, params, attempt, f))
+
+  def done(self, name, params, attempt, future):
+    try:
+      jobs[name].finish(params, future.result())
+    except Exception:
+      self.retry(name, params, attempt)
+    finally:
+      with self.lock:
+        self.pending.discard(future)
+
+  def retry(self, name, params, attempt):
+    logging.exception('Job %s %s failed (attempt %d)' % (name, params, attempt + 1))
+    if attempt < self.retries:
+      self.submit(name, params, attempt + 1)
+    else:
+      jobs[name].fail(params)
+
+  def wait(self):
+    """Block until all submitted jobs, including retries, have finished."""
+    while True:
+      with self.lock:
+        pending = list(self.pending)
+      if not pending:
+        return
+      concurrent.futures.wait(pending)
+
+
+def is_development_server():
+  return os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+
+_backend = None
+
+def get_backend():
+  global _backend
+  if _backend is None:
+    name = os.environ.get('PIPELINE_BACKEND')
+    if name is None:
+      name = 'local' if is_development_server() or taskqueue is None else 'taskqueue'
+    _backend = TaskQueueBackend() if name == 'taskqueue' else LocalBackend()
+  return _backend
+
+
+def set_backend(backend):
+  """Replace the backend, e.g., with a LocalBackend configured for tests."""
+  global _backend
+  _backend = backend
+
+
+def enqueue(name, params):
+  """Schedule job name to run with params, a dictionary of strings."""
+  get_backend().submit(name, params)
+
+
+class LocalScheduler(object):
+  """Calls functions periodically from a daemon thread."""
+  def __init__(self):
+    self.tasks = [] # [next run time, seconds, function]
+    self.lock = threading.Lock()
+    self.thread = None
+
+  def add(self, seconds, function):
+    with self.lock:
+      self.tasks.append([time.time() + seconds, seconds, function])
+
+  def start(self):
+    with self.lock:
+      if self.thread is None and self.tasks:
+        self.thread = threading.Thread(target=self.loop, name='LocalScheduler')
+        self.thread.daemon = True
+        self.thread.start()
+
+  def loop(self):
+    while True:
+      with self.lock:
+        now = time.time()
+        due = [task for task in self.tasks if task[0] <= now]
+        for task in due:
+          task[0] = now + task[1]
+        wake = min(task[0] for task in self.tasks)
+      for (_, _, function) in due:
+        try:
+          function()
+        except Exception:
+          logging.exception('Scheduled call to %s failed' % (function.__name__,))
+      time.sleep(max(0, wake - time.time()))
+
+
+_scheduler = LocalScheduler()
+
+def every(seconds, function):
+  """Call function every so many seconds on the development server, once
+  it has served a request (see scheduled). In production, add an equivalent
+  entry to cron.yaml instead."""
+  _scheduler.add(seconds, function)
+
+
+def scheduled(app):
+  """Wrap a WSGI application so that, on the development server, its first
+  request starts the functions registered with every()."""
+  def application(environ, start_response):
+    if _scheduler.thread is None and is_development_server():
+      _scheduler.start()
+    return app(environ, start_response)
+  return application
+
+
+class Worker(webapp2.RequestHandler):
+  """Runs jobs delivered by the task queue backend."""
+  def post(self):
+    params = dict((arg, self.request.get(arg)) for arg in self.request.arguments())
+    job = jobs[params.pop('job')]
+    retries = int(self.request.headers.get('X-AppEngine-TaskRetryCount', 0))
+    try:
+      job.execute(params)
+    except Exception:
+      if retries < RETRIES:
+        raise # fail the task so that the queue retries it
+      logging.exception('Job %s %s failed (attempt %d)' % (job.name, params, retries + 1))
+      job.fail(params)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Score a directory of submissions outside the App Engine app.
+
+Every file in the directory is scored by every scorer (or those chosen with
+-s) in a pool of worker processes, each of which loads the reference data
+once, before it times any file. Scorers that score the dev set in chunks
+(decode) have every chunk scored here, so all scores are final. Writes one
+row per file and scorer, with the time it took:
+
+  python score.py -s alignment,rerank -f json submissions/ > scores.json
+
+This needs NumPy but not the App Engine SDK, e.g., to grade late
+submissions or to check that a change to a scorer leaves scores alone.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import optparse
+import importlib
+import multiprocessing
+
+SCORERS = ['upload_number', 'alignment', 'decode', 'evaluation', 'rerank', 'inflect']
+
+FIELDS = ['file', 'scorer', 'dev_score', 'dev_percent_complete', 'test_score', 'test_percent_complete',
+          'seconds', 'error']
+
+
+def load_reference_data(filename, names):
+  """Score a sample file with each scorer, untimed and ignoring errors, so
+  that the reference data each one uses (for decode, that of one chunk) is
+  loaded before any file is timed. Runs once in each worker process."""
+  if filename is None:
+    return
+  with open(filename, 'rb') as f:
+    filedata = f.read()
+  for name in names:
+    scorer = importlib.import_module('scoring.' + name)
+    try:
+      scorer.score_all(filedata, None)
+      if hasattr(scorer, 'score_chunk'):
+        scorer.score_chunk(0, filedata)
+    except Exception:
+      pass
+
+
+def score_file(args):
+  """Score one file with one scorer. Returns a row of FIELDS; seconds is
+  the time taken to score the file once it has been read."""
+  (filename, name) = args
+  scorer = importlib.import_module('scoring.' + name)
+  row = dict.fromkeys(FIELDS)
+  (row['file'], row['scorer']) = (filename, name)
+  start = None
+  try:
+    with open(filename, 'rb') as f:
+      filedata = f.read()
+    start = time.time()
+    (dev, test) = scorer.score_all(filedata, None)
+    if dev[1] < 100 and hasattr(scorer, 'score_chunk'):
+      # the app stores the chunks' sentence scores and sums them (see decode.save_chunk)
+      scores = [score for chunk in scorer.chunks(filedata) for (_, score) in scorer.score_chunk(chunk, filedata)]
+      dev = (sum(scores), 100 * len([s for s in scores if s > float('-inf')]) / max(len(scores), 1))
+    ((row['dev_score'], row['dev_percent_complete']), (row['test_score'], row['test_percent_complete'])) = (dev, test)
+  except Exception as e:
+    logging.exception('Scoring %s with %s failed' % (filename, name))
+    row['error'] = '%s: %s' % (type(e).__name__, e)
+  if start is not None:
+    row['seconds'] = time.time() - start
+  return row
+
+
+def write_csv(rows, out):
+  writer = csv.DictWriter(out, FIELDS)
+  writer.writeheader()
+  writer.writerows(rows)
+
+
+def write_json(rows, out):
+  json.dump(rows, out, indent=2, sort_keys=True)
+  out.write('\n')
+
+
+if __name__ == '__main__':
+  optparser = optparse.OptionParser(usage='%prog [options] DIRECTORY')
+  optparser.add_option("-s", "--scorers", dest="scorers", default=','.join(SCORERS), help="Comma-separated scorers (default=all)")
+  optparser.add_option("-f", "--format", dest="format", default="csv", choices=["csv", "json"], help="Output format: csv or json (default=csv)")
+  optparser.add_option("-o", "--output", dest="output", default=None, help="Output file (default=stdout)")
+  optparser.add_option("-j", "--jobs", dest="jobs", default=multiprocessing.cpu_count(), type="int", help="Worker processes (default=number of CPUs, 0 scores in this process)")
+  optparser.add_option("-v", "--verbose", dest="verbose", default=False, action="store_true", help="Log each scored sentence and reference file load")
+  (opts, args) = optparser.parse_args()
+  if len(args) != 1 or not os.path.isdir(args[0]):
+    optparser.error('expected a directory of submissions')
+  scorers = [name for name in opts.scorers.split(',') if name]
+  unknown = [name for name in scorers if name not in SCORERS]
+  if unknown:
+    optparser.error('unknown scorers: %s' % (', '.join(unknown),))
+  logging.basicConfig(level=logging.INFO if opts.verbose else logging.WARNING)
+
+  files = sorted(os.path.join(args[0], f) for f in os.listdir(args[0]) if os.path.isfile(os.path.join(args[0], f)))
+  tasks = [(filename, name) for filename in files for name in scorers]
+  start = time.time()
+  warm_up = (files[0], scorers) if files else (None, [])
+  if opts.jobs > 0:
+    pool = multiprocessing.Pool(opts.jobs, initializer=load_reference_data, initargs=warm_up)
+    rows = pool.map(score_file, tasks, chunksize=1)
+    pool.close()
+    pool.join()
+  else:
+    load_reference_data(*warm_up)
+    rows = map(score_file, tasks)
+
+  out = open(opts.output, 'wb') if opts.output else sys.stdout
+  (write_json if opts.format == 'json' else write_csv)(rows, out)
+  if opts.output:
+    out.close()
+  errors = len([row for row in rows if row['error']])
+  sys.stderr.write('Scored %d files with %d scorers in %.1fs (%d errors)\n' %
+                   (len(files), len(scorers), time.time() - start, errors))
+  sys.exit(1 if errors else 0)
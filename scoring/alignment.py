@@ -1,7 +1,15 @@
+import re
 import os
 import sys
+import logging
 import optparse
 import datetime
+import itertools
+from collections import namedtuple
+
+import numpy
+
+import reference
 
 ## Assignment info ##############################################
 #
@@ -24,52 +32,131 @@ deadline = datetime.datetime(2014, 02, 17, 23, 00)
 def oracle():
   return float('-inf')
 
+# Each link is encoded as a single integer, (sentence << 2*INDEX_BITS) | (f << INDEX_BITS) | e,
+# so that the links of a whole file can be kept in one sorted array
+INDEX_BITS = 20
+
+# A line of a submission is a space-separated list of f-e links
+LINKS = re.compile(r'(?:\d{1,6}-\d{1,6} )*\d{1,6}-\d{1,6}\Z')
+
+alignment_scores = namedtuple('alignment_scores', 'dev, test, precision, recall')
+
+# dev data is first 37 lines, test data is next 447 lines
+DEV = (0, 37)
+TEST = (37, 484)
+
+def encode(sentence, f, e):
+    return (sentence << 2*INDEX_BITS) | (f << INDEX_BITS) | e
+
+def sentence_of(links):
+    return links >> 2*INDEX_BITS
+
+def contains(sorted_links, links):
+    """Which of links occur in the sorted array sorted_links."""
+    if len(sorted_links) == 0:
+        return numpy.zeros(len(links), dtype=bool)
+    i = numpy.minimum(sorted_links.searchsorted(links), len(sorted_links)-1)
+    return sorted_links[i] == links
+
+class GoldAlignments(object):
+    """The sure and possible links of every sentence, as sorted arrays."""
+    def __init__(self, sure, possible, sentences):
+        self.sure = numpy.unique(numpy.array(sure, dtype=numpy.int64))
+        self.possible = numpy.unique(numpy.array(possible, dtype=numpy.int64))
+        self.sentences = sentences
+
+    def __len__(self):
+        return self.sentences
+
+def read_gold(f):
+    """Parse gold alignments (f-e for sure links, f?e for possible ones)."""
+    (sure, possible, sentences) = ([], [], 0)
+    for (i, g) in enumerate(f):
+        for x in g.strip().split():
+            links = sure if x.find("-") > -1 else possible
+            (fi, ei) = map(int, x.replace("?", "-").split("-"))
+            links.append(encode(i, fi, ei))
+        sentences += 1
+    return GoldAlignments(sure, possible, sentences)
+
+gold_alignments = reference.register('alignment.gold', 'alignment_data/hansards.a', read_gold)
+
+def read_alignment(lines):
+    """Returns the sorted, distinct links of a submission, or None if any
+    line is not a list of f-e links."""
+    tokens = [line.split() for line in lines]
+    text = ' '.join(itertools.chain.from_iterable(tokens))
+    if not text:
+        return numpy.zeros(0, dtype=numpy.int64)
+    if not LINKS.match(text):
+        bad = [i for (i, t) in enumerate(tokens) if t and not LINKS.match(' '.join(t))]
+        logging.warning('Malformed alignment on line %d' % (bad[0]+1,))
+        return None
+    numbers = numpy.array(text.replace('-', ' ').split(), dtype=numpy.int64)
+    sentence = numpy.repeat(numpy.arange(len(tokens), dtype=numpy.int64), [len(t) for t in tokens])
+    return numpy.unique(encode(sentence, numbers[0::2], numbers[1::2]))
+
+def link_counts(gold, alignment, sentences):
+    """Per-sentence sizes of A, S, A&S and A&P (which includes A&S, as in
+    the definition of AER), as arrays over the first sentences sentences."""
+    def per_sentence(links):
+        return numpy.bincount(sentence_of(links), minlength=sentences)[:sentences].astype(float)
+    gold_sure = gold.sure[sentence_of(gold.sure) < sentences]
+    a_and_s = alignment[contains(gold.sure, alignment)]
+    a_and_p = alignment[contains(gold.possible, alignment)]
+    return (per_sentence(alignment),
+            per_sentence(gold_sure),
+            per_sentence(a_and_s),
+            per_sentence(a_and_p) + per_sentence(a_and_s))
+
+def aer(counts, start, end):
+    """Alignment error rate of sentences start to end, given link_counts."""
+    (size_a, size_s, size_a_and_s, size_a_and_p) = [c[start:end].sum() for c in counts]
+    if size_a + size_s == 0:
+        return 1.0
+    return 1 - ((size_a_and_s + size_a_and_p) / (size_a + size_s))
+
+def evaluate(a_input):
+    """Returns the dev and test AER of a submission and the precision and
+    recall of each sentence (nan where undefined), or None if it is
+    malformed. Lines beyond the gold alignments are ignored, and so are
+    gold sentences beyond the end of the submission."""
+    gold = gold_alignments.get()
+    lines = a_input.split('\n')[:len(gold)]
+    alignment = read_alignment(lines)
+    if alignment is None:
+        return None
+    counts = link_counts(gold, alignment, len(lines))
+    (size_a, size_s, size_a_and_s, size_a_and_p) = counts
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        precision = size_a_and_p / size_a
+        recall = size_a_and_s / size_s
+    return alignment_scores(aer(counts, *DEV), aer(counts, *TEST), precision, recall)
+
+def score_all(a_input, assignment_key):
+    """Returns (score, percent_complete) pairs for the dev and test sets."""
+    scores = evaluate(a_input)
+    if scores is None:
+        return (float('inf'), 100), (float('inf'), 100)
+    return ((scores.dev, 100), (scores.test, 100))
+
 def score(a_input, assignment_key, test = False):
-    f_data, e_data, a_data = map(open, ['%s/alignment_data/hansards.%s' % (os.path.dirname(os.path.realpath(__file__)), x) for x in ['f','e','a']])
-
-    (size_a, size_s, size_a_and_s, size_a_and_p) = (0.0,0.0,0.0,0.0)
-    for (i, (f, e, g, a)) in enumerate(zip(f_data, e_data, a_data, a_input.split('\n'))):
-        # dev data is first 37 lines
-        if not test and i >= 37:
-            break
-
-        # test data is next 447 lines
-        if test:
-            if i < 37:
-                continue
-            elif i >= 484:
-                break
-
-        fwords = f.strip().split()
-        ewords = e.strip().split()
-        sure = set([tuple(map(int, x.split("-"))) for x in filter(lambda x: x.find("-") > -1, g.strip().split())])
-        possible = set([tuple(map(int, x.split("?"))) for x in filter(lambda x: x.find("?") > -1, g.strip().split())])
-        alignment = set([tuple(map(int, x.split("-"))) for x in a.strip().split()])
-        size_a += len(alignment)
-        size_s += len(sure)
-        size_a_and_s += len(alignment & sure)
-        size_a_and_p += len(alignment & possible) + len(alignment & sure)
-    
-    precision = size_a_and_p / size_a
-    recall = size_a_and_s / size_s
-    aer = 1 - ((size_a_and_s + size_a_and_p) / (size_a + size_s))
-
-    return (aer, 100)
+    return score_all(a_input, assignment_key)[1 if test else 0]
 
 if __name__ == '__main__':
-    optparser = optparse.OptionParser()
-    optparser.add_option("-d", "--data", dest="train", default="data/hansards", help="Data filename prefix (default=data)")
-    optparser.add_option("-e", "--english", dest="english", default="e", help="Suffix of English filename (default=e)")
-    optparser.add_option("-f", "--french", dest="french", default="f", help="Suffix of French filename (default=f)")
-    optparser.add_option("-a", "--alignments", dest="alignment", default="a", help="Suffix of gold alignments filename (default=a)")
+    optparser = optparse.OptionParser(usage='%prog [options] < alignments')
+    optparser.add_option("-a", "--alignments", dest="alignment", default=None, help="Gold alignments (default=alignment_data/hansards.a)")
     optparser.add_option("-t", default=False, help="Test mode", action='store_true')
     (opts, args) = optparser.parse_args()
-    f_data = "%s.%s" % (opts.train, opts.french)
-    e_data = "%s.%s" % (opts.train, opts.english)
-    a_data = "%s.%s" % (opts.train, opts.alignment)
-
-    precision, recall, aer = score(open(f_data), open(e_data), open(a_data), sys.stdin, opts.t)
-    sys.stdout.write("Precision = %f\nRecall = %f\nAER = %f\n" % (precision, recall, aer))
-
-    for _ in (sys.stdin): # avoid pipe error
-        pass
+    if opts.alignment is not None:
+        gold_alignments.filename = os.path.realpath(opts.alignment)
+    gold = gold_alignments.get()
+    lines = sys.stdin.read().split('\n')[:len(gold)]
+    alignment = read_alignment(lines)
+    if alignment is None:
+        sys.exit('Malformed alignments')
+    counts = link_counts(gold, alignment, len(lines))
+    (start, end) = TEST if opts.t else DEV
+    (size_a, size_s, size_a_and_s, size_a_and_p) = [c[start:end].sum() for c in counts]
+    sys.stdout.write("Precision = %f\nRecall = %f\nAER = %f\n" % (size_a_and_p / max(size_a, 1), size_a_and_s / max(size_s, 1),
+                                                                   aer(counts, start, end)))
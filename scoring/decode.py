@@ -5,10 +5,19 @@ import os
 import math
 import datetime
 import itertools
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, deque
 
-from google.appengine.ext import ndb
-from google.appengine.api import taskqueue
+# The datastore is only needed to store chunk scores and the oracle, which
+# offline scoring (see score.py) does without
+try:
+  from google.appengine.ext import ndb
+  transactional = ndb.transactional()
+except ImportError:
+  ndb = None
+  transactional = lambda function: function
+
+import reference
+from packed import PackedLM, PackedTM, read_lm, read_tm
 
 ## Assignment info ##############################################
 #
@@ -28,33 +37,92 @@ deadline = datetime.datetime(2014, 03, 05, 23, 00)
 
 #################################################################
 
+# A phrase index finds every occurrence of a set of phrases in a sentence in
+# a single left-to-right pass (it is an Aho-Corasick automaton over word IDs),
+# instead of comparing each phrase against each position:
+# index = PhraseIndex([('what', 'has'), ('has', 'been')])
+# list(index.find(('what', 'has', 'been'))) == [(0, 2, ('what', 'has')), (1, 3, ('has', 'been'))]
+class PhraseIndex:
+  def __init__(self, phrases):
+    self.ids = {} # word -> ID
+    self.goto = [{}] # state -> {word ID: next state}; state 0 is the root
+    self.fail = [0] # state -> longest proper suffix that is also a state
+    self.output = [()] # state -> phrases ending at this state
+    for phrase in set(phrases):
+      if len(phrase) > 0:
+        self.add(phrase)
+    self.link()
+
+  def add(self, phrase):
+    state = 0
+    for word in phrase:
+      word_id = self.ids.setdefault(word, len(self.ids))
+      if word_id not in self.goto[state]:
+        self.goto[state][word_id] = len(self.goto)
+        self.goto.append({})
+        self.fail.append(0)
+        self.output.append(())
+      state = self.goto[state][word_id]
+    self.output[state] += (phrase,)
+
+  def link(self):
+    # breadth-first, so that the failure links of shorter suffixes are known
+    queue = deque(self.goto[0].itervalues())
+    while queue:
+      state = queue.popleft()
+      for word_id, next_state in self.goto[state].iteritems():
+        queue.append(next_state)
+        fail = self.fail[state]
+        while fail and word_id not in self.goto[fail]:
+          fail = self.fail[fail]
+        self.fail[next_state] = self.goto[fail].get(word_id, 0)
+        self.output[next_state] += self.output[self.fail[next_state]]
+
+  def find(self, sentence):
+    """ Generate (start, end, phrase) for each phrase occurring in sentence """
+    state = 0
+    for j, word in enumerate(sentence):
+      word_id = self.ids.get(word)
+      if word_id is None: # no phrase contains this word
+        state = 0
+        continue
+      while state and word_id not in self.goto[state]:
+        state = self.fail[state]
+      state = self.goto[state].get(word_id, 0)
+      for phrase in self.output[state]:
+        yield (j+1-len(phrase), j+1, phrase)
+
+  def occurrences(self, sentence):
+    """ Returns a dictionary from phrases to the positions where they start """
+    starts = defaultdict(list)
+    for (i, _, phrase) in self.find(sentence):
+      starts[phrase].append(i)
+    return starts
+
+
 # A translation model is a dictionary where keys are tuples of French words
 # and values are lists of (english, logprob) named tuples. For instance,
 # the French phrase "que se est" has two translations, represented like so:
 # tm[('que', 'se', 'est')] = [
 #   phrase(english='what has', logprob=-0.301030009985), 
 #   phrase(english='what has been', logprob=-0.301030009985)]
+# It is built from a phrase table (see translation_table) keeping only the
+# phrases that occur in the bitext, which are found with french_index, a
+# PhraseIndex of the table's French phrases (built from table if not given).
 # k is a pruning parameter: only the top k translations are kept for each f.
-def all_phrases(sentence):
-  for i in xrange(len(sentence)):
-    for j in xrange(i+1, len(sentence)+1):
-      yield tuple(sentence[i:j])
-
 Phrase = namedtuple("phrase", "english, logprob")
-def TM(filename, k, bitext):
-  logging.info("Reading translation model from %s...\n" % (filename,))
+def TM(table, k, bitext, french_index=None):
+  if french_index is None:
+    french_index = PhraseIndex(table)
   tm = {}
-  f_phrases = set()
-  e_phrases = set()
-  for f, e in bitext: # limit mem use by keeping only useful entries
-    f_phrases |= set(all_phrases(f))
-    e_phrases |= set(all_phrases(e))
-  for line in open(filename).readlines():
-    (f, e, logprob) = line.strip().split(" ||| ")
-    f_phr = tuple(f.split())
-    e_phr = tuple(e.split())
-    if f_phr in f_phrases and e_phr in e_phrases:
-      tm.setdefault(f_phr, []).append(Phrase(e_phr, float(logprob)))
+  f_phrases = set(f_phr for f, _ in bitext for (_, _, f_phr) in french_index.find(f))
+  translations = dict((f_phr, table.get(f_phr, ())) for f_phr in f_phrases)
+  english_index = PhraseIndex(e_phr for entries in translations.itervalues() for (e_phr, _) in entries)
+  e_phrases = set(e_phr for _, e in bitext for (_, _, e_phr) in english_index.find(e))
+  for f_phr, entries in translations.iteritems():
+    for (e_phr, logprob) in entries:
+      if e_phr in e_phrases:
+        tm.setdefault(f_phr, []).append(Phrase(e_phr, logprob))
   for f in tm: # prune all but top k translations
     tm[f].sort(key=lambda x: -x.logprob)
     del tm[f][k:] 
@@ -63,7 +131,7 @@ def TM(filename, k, bitext):
 
 # # A language model scores sequences of English words, and must account
 # # for both beginning and end of each sequence. Example API usage:
-# lm = LM(filename, bitext) # filter to only words in english side of bitext
+# lm = LM(language_table(bitext)) # packed tables are shared by all instances in a process
 # sentence = "This is a test ."
 # lm_state = lm.begin() # initial state is always <s>
 # logprob = 0.0
@@ -71,22 +139,9 @@ def TM(filename, k, bitext):
 #   (lm_state, word_logprob) = lm.score(lm_state, word)
 #   logprob += word_logprob
 # logprob += lm.end(lm_state) # transition to </s>, can also use lm.score(lm_state, "</s>")[1]
-ngram_stats = namedtuple("ngram_stats", "logprob, backoff")
 class LM:
-  def __init__(self, filename, bitext):
-    logging.info("Reading language model from %s...\n" % (filename,))
-    self.table = {}
-    e_words = set(['<s>', '</s>', '<unk>'])
-    for f, e in bitext: # limit mem use by keeping ony useful entries
-      for word in e:
-        e_words.add(word)
-    for line in open(filename):
-      entry = line.strip().split("\t")
-      if len(entry) > 1 and entry[0] != "ngram":
-        (logprob, ngram, backoff) = (float(entry[0]), tuple(entry[1].split()), float(entry[2] if len(entry)==3 else 0.0))
-        if all(word in e_words for word in ngram):
-          self.table[ngram] = ngram_stats(logprob, backoff)
-    logging.info("Retained %d lm entries\n" % (len(self.table),))
+  def __init__(self, table):
+    self.table = table
 
   def begin(self):
     return ("<s>",)
@@ -95,8 +150,9 @@ class LM:
     ngram = state + (word,)
     score = 0.0
     while len(ngram)> 0:
-      if ngram in self.table:
-        return (ngram[-2:], score + self.table[ngram].logprob)
+      stats = self.table.get(ngram)
+      if stats is not None:
+        return (ngram[-2:], score + stats.logprob)
       else: #backoff
         score += self.table[ngram[:-1]].backoff if len(ngram) > 1 else 0.0 
         ngram = ngram[1:]
@@ -118,6 +174,13 @@ def logadd10(x,y):
   """ Addition in logspace (base 10): if x=log(a) and y=log(b), returns log(a+b) """
   return x + math.log10(1 + pow(10,y-x))
 
+def logsumexp10(values):
+  """ Addition of a list in logspace (base 10), with one log per call """
+  if len(values) == 1:
+    return values[0]
+  m = max(values)
+  return m + math.log10(sum([pow(10, v-m) for v in values]))
+
 
 def sentence_logprob(f, e, tm, lm):
   lm_state = lm.begin()
@@ -125,6 +188,62 @@ def sentence_logprob(f, e, tm, lm):
   for word in e + ("</s>",):
     (lm_state, word_logprob) = lm.score(lm_state, word)
     lm_logprob += word_logprob
+
+  # Coverage of French words is an integer bitmask: phrase f[fi:fj] is
+  # ((1 << (fj-fi)) - 1) << fi. The translations of every French span are
+  # located in e with one pass of a PhraseIndex.
+  spans = [(fi, fj, tm[f[fi:fj]])
+           for fi in xrange(len(f))
+           for fj in xrange(fi+1,len(f)+1)
+           if f[fi:fj] in tm]
+  starts = PhraseIndex(phrase.english for (_, _, phrases) in spans for phrase in phrases).occurrences(e)
+  alignments = [[] for _ in e]
+  for (fi, fj, phrases) in spans:
+    fbits = ((1 << (fj-fi)) - 1) << fi
+    for phrase in phrases:
+      for ei in starts.get(phrase.english, ()):
+        alignments[ei].append((ei+len(phrase.english), phrase.logprob, fbits))
+
+  # Drop alignments that lead to English positions from which the end of the
+  # sentence can't be reached, and record which French words can still be
+  # covered by alignments starting at or after each English position
+  goal = (1 << len(f)) - 1
+  can_finish = [False for _ in e] + [True]
+  coverable = [0 for _ in e] + [0]
+  for ei in reversed(xrange(len(e))):
+    alignments[ei] = [a for a in alignments[ei] if can_finish[a[0]]]
+    can_finish[ei] = len(alignments[ei]) > 0
+    coverable[ei] = reduce(lambda x,y: x|y, [fbits for (_, _, fbits) in alignments[ei]], coverable[ei+1])
+
+  # Forward algorithm, as in reference_sentence_logprob below. The chart holds,
+  # for each English prefix, the log probabilities of all paths reaching each
+  # coverage; these are summed once, when the prefix is expanded. States that
+  # leave French words which no later alignment covers are never created.
+  chart = [defaultdict(list) for _ in e] + [defaultdict(list)]
+  chart[0][0].append(0.0)
+  for ei in xrange(len(e)):
+    for v, logprobs in chart[ei].iteritems():
+      total = logsumexp10(logprobs)
+      for ej, logprob, fbits in alignments[ei]:
+        if fbits & v == 0:
+          new_v = fbits | v
+          if goal & ~new_v & ~coverable[ej] == 0:
+            chart[ej][new_v].append(total+logprob)
+    chart[ei] = None
+  if goal in chart[len(e)]:
+    return lm_logprob + logsumexp10(chart[len(e)][goal])
+  else:
+    return float('-inf')
+
+
+def reference_sentence_logprob(f, e, tm, lm):
+  """The original, slower implementation of sentence_logprob, kept to check
+  it against (see benchmarks/decode.py)."""
+  lm_state = lm.begin()
+  lm_logprob = 0.0
+  for word in e + ("</s>",):
+    (lm_state, word_logprob) = lm.score(lm_state, word)
+    lm_logprob += word_logprob
   
   alignments = [[] for _ in e]
   for fi in xrange(len(f)):
@@ -160,91 +279,219 @@ def sentence_logprob(f, e, tm, lm):
     return float('-inf')
 
 
-class PerSentenceScores(ndb.Model): # assignment must be the parent
-  score = ndb.FloatProperty(repeated=True)
+if ndb is not None:
+  class PerSentenceScores(ndb.Model): # assignment must be the parent
+    """Per-sentence scores of submissions made before ChunkScores existed."""
+    score = ndb.FloatProperty(repeated=True)
 
 
-@ndb.transactional()
-def set_sentence_scores(assignment_key, sentence_score_pairs):
-  assignment = assignment_key.get()
-  query_result = PerSentenceScores.query(ancestor=assignment_key).fetch()
-  if len(query_result) != 1:
-    logging.error('Found %d PerSentenceScores objects for assignment %s' % (len(query_result), assignment_key))
-    assignment.percent_complete = 100
-  else:
-    pss = query_result[0]
-    for sent_num, score in sentence_score_pairs:
-      pss.score[sent_num] = score
-    pss.put()
-    num = len(filter(lambda x: x > float('-inf'), pss.score))
-    assignment.percent_complete = 100 * num/len(pss.score)
-    if assignment.percent_complete == 100:
-      assignment.score = sum(pss.score)
-  assignment.put()
+  class ChunkScores(ndb.Model):
+    """The scores of one chunk of a submission's sentences. These are root
+    entities (not children of the assignment) so that all the chunks of a
+    submission can be written in parallel without contending."""
+    assignment = ndb.KeyProperty()
+    first = ndb.IntegerProperty() # number of the chunk's first sentence
+    score = ndb.FloatProperty(repeated=True, indexed=False)
+
 
+  class SentenceOracle(ndb.Model):
+    """The best score of each sentence of one chunk over all submissions (see
+    oracle_key). Kept up to date as chunks are scored, so that the oracle
+    never needs to look at individual submissions."""
+    score = ndb.FloatProperty(repeated=True, indexed=False)
+
+
+def read_sentences(f):
+  return [tuple(line.strip().split()) for line in f]
+
+# The models are read from the packed arrays in decoding_data/packed if they
+# have been built (see packed.py), and parsed from the text files otherwise
+PACKED_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'decoding_data', 'packed')
+LM_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'decoding_data', 'lm')
+
+french_sentences = reference.register('decode.input', 'decoding_data/input', read_sentences)
+tm_text = reference.register('decode.tm', 'decoding_data/tm', read_tm)
+tm_packed = reference.register('decode.tm.packed', 'decoding_data/packed/tm.f.npy', lambda f: PackedTM(PACKED_DIR))
+tm_index_text = reference.register('decode.tm.index', 'decoding_data/tm',
+                                   lambda f: PhraseIndex(tuple(line.split(" ||| ")[0].split()) for line in f))
+tm_index_packed = reference.register('decode.tm.index.packed', 'decoding_data/packed/tm.f.npy',
+                                     lambda f: PhraseIndex(PackedTM(PACKED_DIR)))
+lm_packed = reference.register('decode.lm.packed', 'decoding_data/packed/lm.keys.npy', lambda f: PackedLM(PACKED_DIR))
+
+def translation_table():
+  return (tm_packed if tm_packed.exists() else tm_text).get()
+
+def french_index():
+  return (tm_index_packed if tm_packed.exists() else tm_index_text).get()
+
+def language_table(bitext):
+  """The packed language model, or, if it has not been built, the entries of
+  the text one for the English words of bitext. The whole text model takes
+  too much memory to keep, so it is parsed again for every bitext."""
+  if lm_packed.exists():
+    return lm_packed.get()
+  e_words = set(['<s>', '</s>', '<unk>'])
+  for f, e in bitext: # limit mem use by keeping only useful entries
+    e_words.update(e)
+  with open(LM_FILE) as f:
+    table = read_lm(f, e_words)
+  logging.info("Retained %d lm entries\n" % (len(table),))
+  return table
 
 CHUNK_SIZE = 48
 TIMEOUT_MINUTES = 10
 
-def queued_score(data, assignment_key):
-  chunk = int(data)
-  a = assignment_key.get()
-  english_data = a.filedata
-  english = [tuple(line.strip().split()) for line in english_data.strip().split("\n")]
+def chunks(english_data=None):
+  """Returns the numbers of the chunks that score_chunk must be run on."""
+  return range((len(french_sentences.get()) + CHUNK_SIZE - 1) / CHUNK_SIZE)
+
+
+def chunk_key(assignment_key, chunk):
+  return ndb.Key(ChunkScores, '%s:%d' % (assignment_key.id(), chunk))
+
+
+@transactional
+def set_progress(assignment_key, percent_complete, score, rescore=False):
+  assignment = assignment_key.get()
+  if percent_complete > assignment.percent_complete: # chunks may finish in any order
+    assignment.percent_complete = percent_complete
+    if percent_complete == 100:
+      assignment.score = score
+    assignment.put()
+  elif rescore and percent_complete == 100 and score != assignment.score:
+    assignment.score = score
+    assignment.put()
+
+
+def save_chunk(assignment_key, chunk, sentence_score_pairs, rescore=False):
+  """Store the scores of a chunk in a single write, then update the progress
+  (and, once every sentence is scored, the score) of the assignment from
+  all the chunks stored so far. When rescoring a finished submission, the
+  score is updated as each new chunk replaces an old one. The oracle is
+  left to merge_chunk_into_oracle, which contends with every other
+  submission and so is not part of saving one."""
+  ChunkScores(key = chunk_key(assignment_key, chunk),
+              assignment = assignment_key,
+              first = chunk*CHUNK_SIZE,
+              score = [score for _, score in sentence_score_pairs]).put()
+  scores = [score
+            for cs in ndb.get_multi([chunk_key(assignment_key, c) for c in chunks()])
+            if cs is not None
+            for score in cs.score]
+  num = len(filter(lambda x: x > float('-inf'), scores))
+  percent_complete = 100 * num/len(french_sentences.get())
+  set_progress(assignment_key, percent_complete, sum(scores), rescore)
+
+
+def oracle_key(chunk):
+  return ndb.Key(SentenceOracle, 'chunk-%d' % (chunk,))
+
+
+def merge_max(scores, new_scores):
+  return [max(a, b) for a, b in itertools.izip_longest(scores, new_scores, fillvalue=float('-inf'))]
+
+
+@transactional
+def _update_oracle(chunk, scores):
+  oracle = oracle_key(chunk).get() or SentenceOracle(key=oracle_key(chunk))
+  merged = merge_max(oracle.score, scores)
+  if merged != oracle.score:
+    oracle.score = merged
+    oracle.put()
+
+
+def update_oracle(chunk, scores):
+  """Merge a chunk's scores into the oracle, if any of them is an improvement."""
+  oracle = oracle_key(chunk).get()
+  if oracle is None or merge_max(oracle.score, scores) != oracle.score:
+    _update_oracle(chunk, scores)
+
+
+def merge_chunk_into_oracle(assignment_key, chunk):
+  """Merge the stored scores of one chunk of a submission into the oracle."""
+  cs = chunk_key(assignment_key, chunk).get()
+  if cs is not None:
+    update_oracle(chunk, cs.score)
 
-  chunk_start = chunk*CHUNK_SIZE
-  chunk_end = (chunk+1)*CHUNK_SIZE
-  
-  french_file = '%s/decoding_data/input' % os.path.dirname(os.path.realpath(__file__))
-  french = [tuple(line.strip().split()) for line in open(french_file).readlines()]
-  bitext = [(f, e) for (f, e) in zip(french, english)[chunk_start:chunk_end]]
 
-  tm_file = '%s/decoding_data/tm' % os.path.dirname(os.path.realpath(__file__))
-  tm = TM(tm_file, sys.maxint, bitext)
+def models(bitext):
+  """Returns the translation model (for the phrases in bitext) and the
+  language model used to score a list of (french, english) pairs."""
+  tm = TM(translation_table(), sys.maxint, bitext, french_index())
   # tm should translate unknown words as-is with probability 1
-  for word in set(sum(french,())):
+  for word in set(sum(french_sentences.get(),())):
     phr = (word,)
     if phr not in tm:
       tm[phr] = [Phrase(phr, 0.0)]
  
-  lm_file = '%s/decoding_data/lm' % os.path.dirname(os.path.realpath(__file__))
-  lm = LM(lm_file, bitext)
+  return (tm, LM(language_table(bitext)))
+
+
+def score_chunk(chunk, english_data):
+  """Returns (sentence number, logprob) pairs for the sentences in a chunk."""
+  english = [tuple(line.strip().split()) for line in english_data.strip().split("\n")]
+
+  chunk_start = chunk*CHUNK_SIZE
+  chunk_end = (chunk+1)*CHUNK_SIZE
+  
+  french = french_sentences.get()
+  bitext = [(f, e) for (f, e) in zip(french, english)[chunk_start:chunk_end]]
+  (tm, lm) = models(bitext)
   
+  scores = []
   for i, (f, e) in enumerate(bitext):
     sent_num = chunk_start+i
     logprob = sentence_logprob(f,e, tm, lm)
-    logging.info("Scored file %s, sentence %d, result=%.2f\n" % (a.filename, sent_num, logprob))
-    set_sentence_scores(assignment_key, [(sent_num, logprob)])
+    logging.info("Scored sentence %d, result=%.2f\n" % (sent_num, logprob))
+    scores.append((sent_num, logprob))
+  return scores
+
 
-  
 def oracle():
-  french_file = '%s/decoding_data/input' % os.path.dirname(os.path.realpath(__file__))
-  per_sentence_oracle = [float('-inf') for _ in open(french_file).readlines()]
-  query_results = PerSentenceScores.query().fetch()
-  for pss in query_results:
-    per_sentence_oracle = [max(a,b) for a, b in zip(pss.score, per_sentence_oracle)]
+  scores = [cs.score if cs is not None else []
+            for cs in ndb.get_multi([oracle_key(c) for c in chunks()])]
+  per_sentence_oracle = [float('-inf') for _ in french_sentences.get()]
+  for c, chunk_scores in enumerate(scores):
+    for i, score in enumerate(chunk_scores):
+      per_sentence_oracle[c*CHUNK_SIZE + i] = score
   return sum(per_sentence_oracle)
 
 
-def score(english_data, assignment_key, test=False):
-  if not test:
-    # sanity check data: if wrong length, don't even try to score
-    french_file = '%s/decoding_data/input' % os.path.dirname(os.path.realpath(__file__))
-    french = [line for line in open(french_file).readlines()]
-    english = [line for line in english_data.strip().split("\n")]
-    if len(english) != len(french):
-      logging.warning("len(e) = %d, len(f) = %d" % (len(english), len(french)))
-      return (float("-inf"), 100)
-    else:
-      pss = PerSentenceScores(parent = assignment_key, 
-                              score = [float('-inf') for _ in english])
-      pss.put()
-      for i in range(len(english)/CHUNK_SIZE):
-        taskqueue.add(url='/queued_score', 
-                      params={'number': 2, # ugh
-                              'key' : assignment_key.urlsafe(),
-                              'data' : i
-                      })
-      return (float("-inf"), 0)
+# The oracle is rebuilt from every submission ever scored (e.g., after
+# restoring old submissions) by resetting it and then merging in batches of
+# the entities of each of oracle_sources(), which the app does in the
+# background since there are many of them
+def reset_oracle():
+  ndb.delete_multi([oracle_key(c) for c in chunks()])
+
+
+def oracle_sources():
+  return [PerSentenceScores, ChunkScores]
+
+
+def merge_into_oracle(entities):
+  """Merge a batch of PerSentenceScores or ChunkScores into the oracle."""
+  per_sentence_oracle = [float('-inf') for _ in french_sentences.get()]
+  for e in entities:
+    first = e.first if isinstance(e, ChunkScores) else 0
+    for i, score in enumerate(e.score[:len(per_sentence_oracle) - first]):
+      per_sentence_oracle[first + i] = max(score, per_sentence_oracle[first + i])
+  for c in chunks():
+    update_oracle(c, per_sentence_oracle[c*CHUNK_SIZE:(c+1)*CHUNK_SIZE])
+
+
+def score_all(english_data, assignment_key):
+  """Returns (score, percent_complete) pairs for the dev and test sets. The
+  dev set is scored in chunks (see score_chunk); there is no test score."""
+  # sanity check data: if wrong length, don't even try to score
+  french = french_sentences.get()
+  english = [line for line in english_data.strip().split("\n")]
+  if len(english) != len(french):
+    logging.warning("len(e) = %d, len(f) = %d" % (len(english), len(french)))
+    return (float("-inf"), 100), (float("-inf"), 100)
   else:
-    return (float("-inf"), 100)
+    return (float("-inf"), 0), (float("-inf"), 100)
+
+
+def score(english_data, assignment_key, test=False):
+  return score_all(english_data, assignment_key)[1 if test else 0]
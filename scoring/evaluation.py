@@ -2,7 +2,11 @@
 import datetime
 import logging
 import optparse
-import os
+from collections import namedtuple
+
+import numpy
+
+import reference
 
 ## Assignment info ##############################################
 #
@@ -25,21 +29,78 @@ deadline = datetime.datetime(2014, 03, 26, 23, 00)
 def oracle():
   return float('-inf')
   
+# The answers are an int8 array of labels, with a boolean mask for each set
+# (dev or test) saying which labels belong to it
+class Answers(object):
+  def __init__(self, answersets, labels):
+    self.labels = numpy.array(labels, dtype=numpy.int8)
+    answersets = numpy.array(answersets)
+    self.masks = dict((s, answersets == s) for s in set(answersets))
+
+  def __len__(self):
+    return len(self.labels)
+
+def read_answers(f):
+  """Parse the answer file, a list of answerset label lines."""
+  (answersets, labels) = zip(*[x.strip().split() for x in f])
+  return Answers(answersets, [int(label) for label in labels])
+
+answers = reference.register('evaluation.answers', 'eval_data/answers', read_answers)
+
+LABELS = (-1, 0, 1)
+split_scores = namedtuple('split_scores', 'accuracy, right, total, confusion')
+
+def read_labels(e_file, n):
+  """Returns the labels of a submission as an int8 array, or None if it
+  does not have n lines or a line is not an integer. Labels other than
+  -1, 0 and 1 are stored as 2 (they are wrong whatever they were)."""
+  text = e_file.strip()
+  b = numpy.frombuffer(text, dtype=numpy.uint8)
+  ends = numpy.flatnonzero(b == ord('\n'))
+  if len(ends) + 1 != n:
+    logging.info('input len = %d, answer len = %d' %(len(ends) + 1, n))
+    return None
+  # Fast path: every line is exactly -1, 0 or 1
+  starts = numpy.concatenate(([0], ends + 1))
+  stops = numpy.concatenate((ends, [len(b)]))
+  lengths = stops - starts
+  (first, last) = (b[numpy.minimum(starts, len(b)-1)], b[stops-1])
+  digit = (last == ord('0')) | (last == ord('1'))
+  if ((lengths == 1) & digit | (lengths == 2) & (first == ord('-')) & (last == ord('1'))).all():
+    return numpy.where(lengths == 2, -1, last.astype(numpy.int8) - ord('0')).astype(numpy.int8)
+  # Otherwise, e.g. for lines with surrounding whitespace, parse each line
+  try:
+    labels = [int(line.strip()) for line in text.split('\n')]
+  except ValueError:
+    logging.info('input is not a list of labels')
+    return None
+  return numpy.array([label if label in LABELS else 2 for label in labels], dtype=numpy.int8)
+
+def evaluate(e_file):
+  """Returns the accuracy, number right, number of answers and confusion
+  matrix (gold label by submitted label, over -1, 0, 1) of each answer
+  set, or None if the submission can't be scored."""
+  all_answers = answers.get()
+  labels = read_labels(e_file, len(all_answers))
+  if labels is None:
+    return None
+  gold = all_answers.labels
+  right = gold == labels
+  known = labels != 2
+  cell = (gold.astype(numpy.int64) + 1) * len(LABELS) + (labels + 1)
+  scores = {}
+  for s, mask in all_answers.masks.iteritems():
+    total = int(mask.sum())
+    confusion = numpy.bincount(cell[mask & known], minlength=len(LABELS)**2).reshape(len(LABELS), len(LABELS))
+    scores[s] = split_scores(float(right[mask].sum()) / total, int(right[mask].sum()), total, confusion)
+  return scores
+
+def score_all(e_file, assignment_key):
+  """Returns (score, percent_complete) pairs for the dev and test sets."""
+  scores = evaluate(e_file)
+  if scores is None:
+    return (float('-inf'), 100), (float('-inf'), 100)
+  return tuple((scores[s].accuracy, 100) for s in ('dev', 'test'))
+
 def score(e_file, assignment_key, test=False):
-  input = [line.strip() for line in e_file.strip().split('\n')]
-  answerset = 'test' if test else 'dev'
-  answerfile = '%s/eval_data/answers' % (os.path.dirname(os.path.realpath(__file__)),)
-  all_answers = [tuple(x.strip().split()) for x in open(answerfile)]
-  if len(input) != len(all_answers):
-    logging.info('input len = %d, answer len = %d' %(len(input), len(all_answers)))
-    return float('-inf'), 100
-  (right, wrong) = (0.0,0.0)
-  for (i, (sg, sy)) in enumerate(zip(all_answers, input)):
-    if sg[0] == answerset:
-      (g, y) = (int(sg[1]), int(sy))
-      if g == y:
-        right += 1
-      else:
-        wrong += 1
-  
-  return right / (right + wrong), 100
+  return score_all(e_file, assignment_key)[1 if test else 0]
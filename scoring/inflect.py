@@ -6,16 +6,12 @@ inflect_data/dtest.form (development) or inflect_data/etest.form (post-deadline
 
 """
 
-import os
-import sys
-import codecs
 import datetime
-from itertools import izip
+from collections import namedtuple
 
-from google.appengine.ext import ndb
+import numpy
 
-reload(sys)
-sys.setdefaultencoding("utf-8")
+import reference
 
 ## Assignment info ##############################################
 #
@@ -42,24 +38,81 @@ def oracle():
     # query_results = PerSentenceScores.query().fetch()
     return 0.0
 
-def score(e_file, assignment_key, test=False):
-
-    goldfile = '%s/inflect_data/%s' % (os.path.dirname(os.path.realpath(__file__)), 'etest.form' if test else 'dtest.form')
-
-    total = 0
-    right = 0
-    num = 0
-
-    if test:
-        data = e_file.split('\n')[4042:]
-    else:
-        data = e_file.split('\n')[:4042]
-
-    for line, gold in izip(data, codecs.open(goldfile, 'r', 'utf-8')):
-        compared = map(lambda x: x[0] == x[1], izip(line.strip().split(), gold.strip().split()))
-        right += sum(compared)
-        total += len(compared)
-
-    return 1.0 * right / total, 100
-    
+class Vocabulary(dict):
+    """Token IDs; tokens that are not in the vocabulary get -1."""
+    def __missing__(self, token):
+        return -1
+
+class Forms(object):
+    """The tokens of a gold .form file, interned as integer IDs (in order of
+    appearance) and stored end to end, with the offset of each line's first
+    token in offsets and the line of each token in line."""
+    def __init__(self, lines):
+        self.vocab = Vocabulary()
+        ids = [self.vocab.setdefault(token, len(self.vocab)) for line in lines for token in line]
+        self.ids = numpy.array(ids, dtype=numpy.int32)
+        self.offsets = numpy.cumsum([0] + [len(line) for line in lines])
+        self.line = numpy.repeat(numpy.arange(len(lines)), [len(line) for line in lines])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+def read_forms(f):
+    """Tokenize each line of a gold .form file. Tokens are split as unicode
+    but kept as UTF-8 so that they compare directly with submitted tokens."""
+    return Forms([[token.encode('utf-8') for token in line.decode('utf-8').split()] for line in f])
+
+gold_forms = { False: reference.register('inflect.dev', 'inflect_data/dtest.form', read_forms),
+               True:  reference.register('inflect.test', 'inflect_data/etest.form', read_forms) }
+
+inflect_scores = namedtuple('inflect_scores', 'accuracy, right, total, line_accuracy')
+
+def line_offsets(text):
+    """Offsets of the start of each line of text, followed by one past the
+    end of the text, so that line i is text[offsets[i]:offsets[i+1]-1]."""
+    offsets = [0]
+    i = text.find('\n')
+    while i >= 0:
+        offsets.append(i+1)
+        i = text.find('\n', i+1)
+    offsets.append(len(text)+1)
+    return offsets
+
+def compare(text, offsets, first, gold):
+    """Compare lines first, first+1, ... of text with the gold forms, token
+    by token. Only as many tokens as the shorter of each pair of lines has
+    are compared, and lines past the end of either are ignored."""
+    lines = max(0, min(len(gold), len(offsets) - 1 - first))
+    lookup = gold.vocab.__getitem__
+    (submitted, lengths) = ([], [])
+    for i in xrange(lines):
+        tokens = text[offsets[first+i]:offsets[first+i+1]-1].split()
+        size = gold.offsets[i+1] - gold.offsets[i]
+        n = min(len(tokens), size)
+        # line up with the gold tokens, padding with an ID that never matches
+        submitted.extend(map(lookup, tokens[:n]))
+        submitted.extend([-2] * (size - n))
+        lengths.append(n)
+    end = gold.offsets[lines]
+    matches = numpy.array(submitted, dtype=numpy.int32) == gold.ids[:end]
+    right = numpy.bincount(gold.line[:end], weights=matches, minlength=lines)[:lines]
+    total = numpy.array(lengths, dtype=float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        line_accuracy = right / total
+    return inflect_scores(right.sum() / total.sum() if total.sum() > 0 else 0.0,
+                          int(right.sum()), int(total.sum()), line_accuracy)
+
+def evaluate(e_file):
+    """Returns the inflect_scores of the dev and test sets. The per-line
+    accuracy is nan for lines where no tokens were compared."""
+    offsets = line_offsets(e_file)
+    dev = gold_forms[False].get()
+    return (compare(e_file, offsets, 0, dev),
+            compare(e_file, offsets, len(dev), gold_forms[True].get()))
+
+def score_all(e_file, assignment_key):
+    """Returns (score, percent_complete) pairs for the dev and test sets."""
+    return tuple((scores.accuracy, 100) for scores in evaluate(e_file))
 
+def score(e_file, assignment_key, test=False):
+    return score_all(e_file, assignment_key)[1 if test else 0]
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""Compact, memory-mappable versions of decode's translation and language models.
+
+Parsing the text models takes far longer than scoring a chunk, so they can be
+compiled once into NumPy arrays that every process maps straight from disk:
+
+  vocab.npy                  sorted English words (a word's ID is its index)
+  lm.keys.npy                sorted n-gram keys, each packing up to three word IDs
+  lm.logprob.npy, lm.backoff.npy
+                             the n-gram statistics, in the same order as the keys
+  tm.f.npy                   sorted French phrases
+  tm.offsets.npy             tm.f[i]'s translations are entries offsets[i]:offsets[i+1]
+  tm.e.npy, tm.logprob.npy   English phrases and their logprobs, in file order
+
+Usage (from the scoring directory):
+
+  python packed.py decoding_data/tm decoding_data/lm decoding_data/packed
+
+decode uses the packed models whenever decoding_data/packed exists, so build
+them again whenever the text models change.
+
+"""
+
+import os
+import sys
+import optparse
+from collections import namedtuple
+
+import numpy
+
+# IDs are stored shifted by one so that 0 can pad n-grams shorter than MAX_ORDER
+ID_BITS = 21
+MAX_ORDER = 3
+
+ngram_stats = namedtuple("ngram_stats", "logprob, backoff")
+
+
+def load_array(filename):
+  """Memory-map a .npy file, or read it if the runtime does not allow mmap."""
+  try:
+    return numpy.load(filename, mmap_mode='r')
+  except (ImportError, EnvironmentError, ValueError):
+    return numpy.load(filename)
+
+
+def find(array, value):
+  """Returns the index of value in a sorted array, or None."""
+  i = int(array.searchsorted(value))
+  if i < len(array) and array[i] == value:
+    return i
+  return None
+
+
+def pack(ids):
+  key = 0
+  for i in ids:
+    key = (key << ID_BITS) | (i + 1)
+  return key
+
+
+class PackedLM(object):
+  """A language model table backed by the arrays written by build_lm. Maps
+  ngram tuples to ngram_stats like the dictionary returned by decode.read_lm."""
+  def __init__(self, directory):
+    self.vocab = load_array(os.path.join(directory, 'vocab.npy'))
+    self.keys = load_array(os.path.join(directory, 'lm.keys.npy'))
+    self.logprob = load_array(os.path.join(directory, 'lm.logprob.npy'))
+    self.backoff = load_array(os.path.join(directory, 'lm.backoff.npy'))
+    self.ids = {}
+
+  def word_id(self, word):
+    if word not in self.ids:
+      self.ids[word] = find(self.vocab, word)
+    return self.ids[word]
+
+  def get(self, ngram, default=None):
+    if len(ngram) > MAX_ORDER:
+      return default
+    ids = [self.word_id(word) for word in ngram]
+    if None in ids:
+      return default
+    i = find(self.keys, pack(ids))
+    if i is None:
+      return default
+    return ngram_stats(float(self.logprob[i]), float(self.backoff[i]))
+
+  def __getitem__(self, ngram):
+    stats = self.get(ngram)
+    if stats is None:
+      raise KeyError(ngram)
+    return stats
+
+  def __contains__(self, ngram):
+    return self.get(ngram) is not None
+
+  def __len__(self):
+    return len(self.keys)
+
+
+class PackedTM(object):
+  """A phrase table backed by the arrays written by build_tm. Maps French
+  phrase tuples to lists of (english, logprob) pairs like the dictionary
+  returned by decode.read_tm."""
+  def __init__(self, directory):
+    self.f = load_array(os.path.join(directory, 'tm.f.npy'))
+    self.offsets = load_array(os.path.join(directory, 'tm.offsets.npy'))
+    self.e = load_array(os.path.join(directory, 'tm.e.npy'))
+    self.logprob = load_array(os.path.join(directory, 'tm.logprob.npy'))
+
+  def get(self, f_phrase, default=None):
+    i = find(self.f, ' '.join(f_phrase))
+    if i is None:
+      return default
+    (start, end) = (int(self.offsets[i]), int(self.offsets[i+1]))
+    return [(tuple(self.e[j].split()), float(self.logprob[j])) for j in xrange(start, end)]
+
+  def __getitem__(self, f_phrase):
+    translations = self.get(f_phrase)
+    if translations is None:
+      raise KeyError(f_phrase)
+    return translations
+
+  def __contains__(self, f_phrase):
+    return find(self.f, ' '.join(f_phrase)) is not None
+
+  def __iter__(self):
+    for f_phrase in self.f:
+      yield tuple(f_phrase.split())
+
+  def __len__(self):
+    return len(self.f)
+
+
+def build_lm(lm, directory):
+  """Write the arrays of a language model given as a dictionary from ngram
+  tuples to (logprob, backoff) pairs."""
+  vocab = numpy.array(sorted(set(word for ngram in lm for word in ngram)))
+  if len(vocab) >= (1 << ID_BITS) - 1:
+    raise ValueError('Vocabulary of %d words is too large to pack' % (len(vocab),))
+  ids = dict((word, i) for i, word in enumerate(vocab))
+  ngrams = lm.keys()
+  if any(len(ngram) > MAX_ORDER for ngram in ngrams):
+    raise ValueError('Only language models up to order %d can be packed' % (MAX_ORDER,))
+  keys = numpy.array([pack([ids[word] for word in ngram]) for ngram in ngrams], dtype=numpy.int64)
+  order = keys.argsort()
+  numpy.save(os.path.join(directory, 'vocab.npy'), vocab)
+  numpy.save(os.path.join(directory, 'lm.keys.npy'), keys[order])
+  numpy.save(os.path.join(directory, 'lm.logprob.npy'),
+             numpy.array([lm[ngram][0] for ngram in ngrams], dtype=numpy.float64)[order])
+  numpy.save(os.path.join(directory, 'lm.backoff.npy'),
+             numpy.array([lm[ngram][1] for ngram in ngrams], dtype=numpy.float64)[order])
+
+
+def build_tm(tm, directory):
+  """Write the arrays of a phrase table given as a dictionary from French
+  phrase tuples to lists of (english, logprob) pairs."""
+  f_phrases = sorted(tm, key=lambda f: ' '.join(f))
+  offsets = [0]
+  for f in f_phrases:
+    offsets.append(offsets[-1] + len(tm[f]))
+  numpy.save(os.path.join(directory, 'tm.f.npy'), numpy.array([' '.join(f) for f in f_phrases]))
+  numpy.save(os.path.join(directory, 'tm.offsets.npy'), numpy.array(offsets, dtype=numpy.int64))
+  numpy.save(os.path.join(directory, 'tm.e.npy'),
+             numpy.array([' '.join(e) for f in f_phrases for (e, _) in tm[f]]))
+  numpy.save(os.path.join(directory, 'tm.logprob.npy'),
+             numpy.array([logprob for f in f_phrases for (_, logprob) in tm[f]], dtype=numpy.float64))
+
+
+def read_tm(f):
+  """Parse a phrase table into a dictionary from French phrases to lists of
+  (english, logprob) pairs, in file order."""
+  tm = {}
+  for line in f:
+    (fr, e, logprob) = line.strip().split(" ||| ")
+    tm.setdefault(tuple(fr.split()), []).append((tuple(e.split()), float(logprob)))
+  return tm
+
+
+def read_lm(f, words=None):
+  """Parse an ARPA-style language model into a dictionary from ngrams to
+  stats, keeping only the ngrams made up of words, if given."""
+  table = {}
+  for line in f:
+    entry = line.strip().split("\t")
+    if len(entry) > 1 and entry[0] != "ngram":
+      (logprob, ngram, backoff) = (float(entry[0]), tuple(entry[1].split()), float(entry[2] if len(entry)==3 else 0.0))
+      if words is None or all(word in words for word in ngram):
+        table[ngram] = ngram_stats(logprob, backoff)
+  return table
+
+
+if __name__ == '__main__':
+  optparser = optparse.OptionParser(usage='%prog TM LM OUTPUT_DIR')
+  (opts, args) = optparser.parse_args()
+  if len(args) != 3:
+    optparser.error('expected a phrase table, a language model and an output directory')
+  (tm_file, lm_file, directory) = args
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  build_tm(read_tm(open(tm_file)), directory)
+  build_lm(read_lm(open(lm_file)), directory)
+  sys.stderr.write('Wrote packed models to %s\n' % (directory,))
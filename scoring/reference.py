@@ -0,0 +1,100 @@
+"""A registry of the reference data used by the scorers.
+
+Each reference file is parsed once per process, on first use, into whatever
+compact form its scorer needs, and shared by every later call. A file is
+parsed again if its modification time changes; the check is made at most
+once every RELOAD_CHECK_SECONDS so that warm instances score without
+touching the disk. Example:
+
+  answers = reference.register('evaluation.answers', 'eval_data/answers', parse_answers)
+  ...
+  for (answerset, label) in answers.get(): ...
+
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+
+DATA_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# How often (in seconds) to check whether a reference file has changed
+RELOAD_CHECK_SECONDS = 10
+
+_registry = {}
+
+
+def sizeof(obj, seen=None):
+  """Approximate memory use of obj, including everything it contains."""
+  if seen is None:
+    seen = set()
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  size = sys.getsizeof(obj)
+  if isinstance(obj, dict):
+    size += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.iteritems())
+  elif isinstance(obj, (list, tuple, set, frozenset)):
+    size += sum(sizeof(x, seen) for x in obj)
+  elif hasattr(obj, 'nbytes'): # numpy arrays
+    size += obj.nbytes
+  return size
+
+
+class ReferenceData(object):
+  """A reference file and its parsed contents."""
+  def __init__(self, name, filename, parse):
+    self.name = name
+    self.filename = os.path.join(DATA_DIR, filename)
+    self.parse = parse
+    self.data = None
+    self.mtime = None
+    self.checked = 0.0
+    self.loads = 0
+    self.load_seconds = 0.0
+    self.bytes = 0
+    self.lock = threading.Lock()
+
+  def exists(self):
+    return os.path.exists(self.filename)
+
+  def get(self):
+    now = time.time()
+    if self.data is not None and now - self.checked < RELOAD_CHECK_SECONDS:
+      return self.data
+    with self.lock:
+      mtime = os.path.getmtime(self.filename)
+      self.checked = now
+      if self.data is None or mtime != self.mtime:
+        start = time.time()
+        with open(self.filename, 'rb') as f:
+          self.data = self.parse(f)
+        self.mtime = mtime
+        self.loads += 1
+        self.load_seconds = time.time() - start
+        self.bytes = sizeof(self.data)
+        logging.info('Loaded reference data %s in %.3fs (%d bytes)' % (self.name, self.load_seconds, self.bytes))
+      return self.data
+
+  def stats(self):
+    return { 'name': self.name,
+             'filename': self.filename,
+             'loaded': self.data is not None,
+             'loads': self.loads,
+             'load_seconds': self.load_seconds,
+             'bytes': self.bytes }
+
+
+def register(name, filename, parse):
+  """Register a reference file (relative to the scoring directory) and the
+  function that parses its open file object. Nothing is read until get()."""
+  if name not in _registry:
+    _registry[name] = ReferenceData(name, filename, parse)
+  return _registry[name]
+
+
+def stats():
+  """Returns load statistics for every registered reference file."""
+  return [_registry[name].stats() for name in sorted(_registry)]
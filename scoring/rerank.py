@@ -2,10 +2,13 @@
 import datetime
 import logging
 import optparse
-import os
 import math
 from collections import Counter
 
+import numpy
+
+import reference
+
 ## Assignment info ##############################################
 #
 # All four values must be defined
@@ -49,20 +52,119 @@ def bleu(stats):
   log_bleu_prec = sum([math.log(float(x)/y) for x,y in zip(stats[2::2],stats[3::2])]) / 4.
   return math.exp(min([0, 1-float(r)/c]) + log_bleu_prec)
 
-def score(e_file, assignment_key, test=False):
+def count_sorted(values):
+  """Returns the distinct values of a sorted array and how often each occurs."""
+  if len(values) == 0:
+    return values, numpy.zeros(0, dtype=numpy.int64)
+  starts = numpy.flatnonzero(numpy.concatenate(([True], values[1:] != values[:-1])))
+  return values[starts], numpy.diff(numpy.concatenate((starts, [len(values)])))
+
+def lookup(sorted_keys, keys):
+  """Returns the positions of keys in sorted_keys, and which of them are there."""
+  if len(sorted_keys) == 0:
+    return numpy.zeros(len(keys), dtype=numpy.int64), numpy.zeros(len(keys), dtype=bool)
+  i = numpy.minimum(sorted_keys.searchsorted(keys), len(sorted_keys)-1)
+  return i, sorted_keys[i] == keys
+
+class BleuReference(object):
+  """A set of reference translations with their n-gram counts computed once,
+  so that hypotheses can be scored against them in a batch.
+
+  Words are numbered from 1 in order of appearance, and each n-gram of the
+  references (up to 4-grams) gets a dense ID within its order, computed
+  from the ID of its (n-1)-gram prefix and its last word. stats() finds the
+  IDs of all the hypothesis n-grams the same way, so counting matches is
+  a matter of sorting and searching integer arrays."""
+  def __init__(self, sentences):
+    self.sentences = sentences
+    self.vocab = {}
+    for sentence in sentences:
+      for word in sentence:
+        self.vocab.setdefault(word, len(self.vocab)+1)
+    (sent, ids) = self.encode(sentences)
+    self.ngrams = [] # for each order, the sorted keys of the reference n-grams
+    self.counts = [] # for each order, sorted (sentence, n-gram ID) keys and their counts
+    dense = ids
+    for n in xrange(1,5):
+      (p, keys) = self.ngram_keys(sent, ids, dense, n)
+      self.ngrams.append(numpy.unique(keys))
+      dense = numpy.zeros(len(ids), dtype=numpy.int64)
+      dense[p] = self.ngrams[-1].searchsorted(keys)
+      combined = sent[p] * len(self.ngrams[-1]) + dense[p]
+      combined.sort()
+      self.counts.append(count_sorted(combined))
+
+  def __len__(self):
+    return len(self.sentences)
+
+  def encode(self, sentences):
+    """Returns the sentence number and word ID of every token in sentences
+    (0 for words that are not in the references)."""
+    lengths = [len(sentence) for sentence in sentences]
+    sent = numpy.repeat(numpy.arange(len(sentences), dtype=numpy.int64), lengths)
+    ids = numpy.fromiter((self.vocab.get(word, 0) for sentence in sentences for word in sentence),
+                         dtype=numpy.int64, count=sum(lengths))
+    return sent, ids
+
+  def ngram_keys(self, sent, ids, dense, n):
+    """Returns the start positions of the n-grams whose words are all known,
+    and their keys, given the dense IDs of the (n-1)-grams at each position."""
+    if n == 1:
+      p = numpy.flatnonzero(ids > 0)
+      return p, ids[p]
+    last = numpy.arange(n-1, len(ids))
+    p = last - (n-1)
+    known = (sent[p] == sent[last]) & (dense[p] >= 0) & (ids[last] > 0)
+    (p, last) = (p[known], last[known])
+    return p, dense[p] * (len(self.vocab)+1) + ids[last]
+
+  def stats(self, hypotheses):
+    """Returns the bleu_stats of each hypothesis against the reference with
+    the same index, as the rows of an integer matrix. Summing any subset of
+    rows gives the statistics needed to compute the BLEU of that subset."""
+    hypotheses = hypotheses[:len(self)]
+    lengths = numpy.array([len(h) for h in hypotheses], dtype=numpy.int64)
+    stats = numpy.zeros((len(hypotheses), 10), dtype=numpy.int64)
+    stats[:,0] = lengths
+    stats[:,1] = [len(r) for r in self.sentences[:len(hypotheses)]]
+    (sent, ids) = self.encode(hypotheses)
+    dense = ids
+    for n in xrange(1,5):
+      (p, keys) = self.ngram_keys(sent, ids, dense, n)
+      (i, found) = lookup(self.ngrams[n-1], keys)
+      dense = numpy.zeros(len(ids), dtype=numpy.int64) - 1 # -1: not a reference n-gram
+      dense[p[found]] = i[found]
+      (p, i) = (p[found], i[found])
+      combined = sent[p] * len(self.ngrams[n-1]) + i
+      combined.sort()
+      (keys, hyp_counts) = count_sorted(combined)
+      (ref_keys, ref_counts) = self.counts[n-1]
+      (j, found) = lookup(ref_keys, keys)
+      clipped = numpy.where(found, numpy.minimum(hyp_counts, ref_counts[j]), 0)
+      stats[:,2*n] = numpy.bincount(keys // len(self.ngrams[n-1]), weights=clipped, minlength=len(hypotheses))[:len(hypotheses)]
+      stats[:,2*n+1] = numpy.maximum(lengths+1-n, 0)
+    return stats
+
+def read_references(f):
+  return BleuReference([tuple(line.strip().split()) for line in f])
+
+references = { 'dev': reference.register('rerank.dev', 'rerank_data/dev.ref', read_references),
+               'test': reference.register('rerank.test', 'rerank_data/test.ref', read_references) }
+
+def corpus_bleu(ref, hyp):
+  return 100*bleu(ref.stats(hyp).sum(axis=0))
+
+def sentence_bleu(stats):
+  """BLEU of each row of a matrix returned by BleuReference.stats."""
+  return [100*bleu(row) for row in stats]
+
+def score_all(e_file, assignment_key):
+  """Returns (score, percent_complete) pairs for the dev and test sets."""
   hyp = [tuple(line.strip().split()) for line in e_file.strip().split('\n')]
   if len(hyp) != 800:
-    return 0.0
-  answerset = 'test' if test else 'dev'
-  answerfile = '%s/rerank_data/%s.ref' % (os.path.dirname(os.path.realpath(__file__)),answerset)
-  ref = [tuple(line.strip().split()) for line in open(answerfile)]
-  if test:
-    hyp = hyp[400:]
-  else:
-    hyp = hyp[:400]
-
-  stats = [0 for i in xrange(10)]
-  for (r,h) in zip(ref, hyp):
-    stats = [sum(scores) for scores in zip(stats, bleu_stats(h,r))]
-  return (100*bleu(stats), 100)
+    return (0.0, 100), (0.0, 100)
+  return ((corpus_bleu(references['dev'].get(), hyp[:400]), 100),
+          (corpus_bleu(references['test'].get(), hyp[400:]), 100))
 
+def score(e_file, assignment_key, test=False):
+  return score_all(e_file, assignment_key)[1 if test else 0]
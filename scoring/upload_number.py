@@ -21,10 +21,14 @@ deadline = datetime.datetime(2014, 02, 10, 23, 00)
 def oracle():
   return float('-inf')
 
-def score(filedata, assignment_key, test=None):
-  """Homework 0 (setup)."""
+def score_all(filedata, assignment_key):
+  """Homework 0 (setup): the dev and test scores are the same."""
   value = filedata.split('\n')[0]
   try:
-    return (((float(value)-1.0) % 100) + 1, 100)
+    result = (((float(value)-1.0) % 100) + 1, 100)
   except ValueError:
-    return (-1, 100)
+    result = (-1, 100)
+  return result, result
+
+def score(filedata, assignment_key, test=None):
+  return score_all(filedata, assignment_key)[1 if test else 0]